@@ -0,0 +1,73 @@
+"""Microbenchmarks of embed_cms_images and embed_youtube_links.
+
+    python -m benchmarks.bench_embed [--repeat 50]
+
+Times both on posts the size of what the CMS actually serves, from a short
+news item to a long build log, with each rewriter backend and with and
+without srcset for resized images.
+"""
+import argparse
+import time
+
+from flask import Flask
+
+from benchmarks.bench_rewrite import make_post
+from hackspace_website.rewrite import embed_cms_images, embed_youtube_links
+
+# name -> (images, YouTube links, paragraphs)
+POST_SIZES = {
+    "news item": (1, 0, 6),
+    "typical post": (8, 1, 30),
+    "long build log": (40, 5, 150),
+}
+
+
+def _app(backend: str, variants: bool) -> Flask:
+    app = Flask(__name__)
+    app.config.update(
+        HTML_REWRITER_BACKEND=backend,
+        PUBLIC_MEDIA_URL="/media/",
+        MEDIA_VARIANTS_ENABLED=variants,
+        MEDIA_CACHE_ENABLED=True,
+        MEDIA_VARIANT_WIDTHS=(320, 640, 960, 1280, 1920),
+        MEDIA_VARIANT_SIZES="(min-width: 1667px) 1600px, 96vw",
+    )
+    return app
+
+
+def bench(func, html: str, repeat: int) -> float:
+    func(html)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(html)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    functions = {
+        "embed_cms_images": lambda html: embed_cms_images(html, "http://cms:8000"),
+        "embed_youtube_links": embed_youtube_links,
+    }
+    print(f"{'post':<16} {'size':>7}  {'function':<20} {'backend':<14} {'ms/call':>9} {'MB/s':>7}")
+    for post_name, (images, links, paragraphs) in POST_SIZES.items():
+        html = make_post(images, links, paragraphs)
+        size = len(html.encode())
+        for func_name, func in functions.items():
+            # srcset only changes what embed_cms_images does
+            srcset = (False, True) if func_name == "embed_cms_images" else (False,)
+            for backend, variants in ((b, v) for b in ("soup", "lxml") for v in srcset):
+                with _app(backend, variants).app_context():
+                    per_call = bench(func, html, args.repeat)
+                label = backend + (" +srcset" if variants else "")
+                print(
+                    f"{post_name:<16} {size / 1024:>5.0f}KB  {func_name:<20} {label:<14} "
+                    f"{per_call * 1000:>9.3f} {size / per_call / 1e6:>7.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Throughput of the blog body rewrite on large generated posts.
+
+    python -m benchmarks.bench_rewrite [--images 200] [--repeat 20]
+
+Compares the single-pass RewritePipeline and the streaming lxml backend
+against the previous approach of running two separate BeautifulSoup passes,
+reporting time per post and peak memory allocated while rewriting.
+"""
+import argparse
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from hackspace_website.rewrite import (
+    MEDIA_ANYWHERE_RE,
+    YOUTUBE_ID_RE,
+    _rewrite_to_public_media,
+    default_pipeline,
+)
+
+PUBLIC_BASE = "http://127.0.0.1:5000/media"
+
+
+def make_post(images: int, links: int, paragraphs: int) -> str:
+    parts = []
+    for i in range(paragraphs):
+        parts.append(
+            f"<p>Paragraph {i} of the build log with some <strong>bold</strong> text, "
+            f"a <a href=\"https://example.com/{i}\">normal link</a> and &amp; entities.</p>"
+        )
+        if i < images:
+            kind = i % 3
+            if kind == 0:
+                parts.append(f'<p><img src="http://cms:8000/media/blog_body_images/photo_{i}.jpg" alt="photo {i}"></p>')
+            elif kind == 1:
+                parts.append(f'<p><a href="http://cms:8000/media/blog_body_images/photo_{i}.png">photo {i}</a></p>')
+            else:
+                parts.append(f"<p>http://cms:8000/media/blog_body_images/photo_{i}.webp</p>")
+        if i < links:
+            if i % 2:
+                parts.append(f'<p><a href="https://www.youtube.com/watch?v=vid{i:05d}">video</a></p>')
+            else:
+                parts.append(f"<p>Watch https://www.youtube.com/watch?v=vid{i:05d} too</p>")
+    return "\n".join(parts)
+
+
+def _legacy_soup_html(soup):
+    body = soup.body
+    return "".join(str(x) for x in (body.contents if body else soup.contents))
+
+
+def legacy_two_pass(html: str) -> str:
+    # The original embed_cms_images followed by embed_youtube_links, kept here
+    # for comparison only.
+    soup = BeautifulSoup(html, "lxml")
+    for img in soup.find_all("img", src=True):
+        img["src"] = _rewrite_to_public_media(img["src"], PUBLIC_BASE)
+    for a in soup.find_all("a", href=True):
+        href = a["href"].strip()
+        new_src = _rewrite_to_public_media(href, PUBLIC_BASE)
+        if new_src != href:
+            a.replace_with(BeautifulSoup(f'<img class="blog-body-image" src="{new_src}" alt="">', "lxml"))
+    for text_node in soup.find_all(string=True):
+        text = (str(text_node) or "").strip()
+        if text and MEDIA_ANYWHERE_RE.search(text):
+            new_src = _rewrite_to_public_media(text, PUBLIC_BASE)
+            text_node.replace_with(BeautifulSoup(f'<img class="blog-body-image" src="{new_src}" alt="">', "lxml"))
+    html = _legacy_soup_html(soup)
+
+    soup = BeautifulSoup(html, "lxml")
+    iframe = '<div class="video-embed"><iframe src="https://www.youtube.com/embed/{}"></iframe></div>'
+    for a in soup.find_all("a", href=True):
+        m = YOUTUBE_ID_RE.search(a["href"])
+        if m:
+            a.replace_with(BeautifulSoup(iframe.format(m.group(1)), "lxml"))
+    for text_node in soup.find_all(string=True):
+        if "youtube" in text_node:
+            m = YOUTUBE_ID_RE.search(str(text_node))
+            if m:
+                text_node.replace_with(BeautifulSoup(iframe.format(m.group(1)), "lxml"))
+    return _legacy_soup_html(soup)
+
+
+def bench(name: str, func, html: str, repeat: int):
+    func(html)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(html)
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / repeat
+    mb_per_s = len(html.encode()) / per_call / 1e6
+
+    tracemalloc.start()
+    func(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(
+        f"{name:<24} {per_call * 1000:9.2f} ms/post {1 / per_call:9.1f} posts/s "
+        f"{mb_per_s:7.2f} MB/s {peak / 1e6:8.1f} MB peak"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--links", type=int, default=50)
+    parser.add_argument("--paragraphs", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    html = make_post(args.images, args.links, args.paragraphs)
+    print(f"post: {len(html) / 1024:.0f} KiB, {args.images} images, {args.links} YouTube links\n")
+
+    soup = default_pipeline("soup")
+    stream = default_pipeline("lxml")
+    bench("two-pass (legacy)", legacy_two_pass, html, args.repeat)
+    bench("single-pass pipeline", lambda h: soup.rewrite(h, PUBLIC_BASE), html, args.repeat)
+    bench("streaming lxml", lambda h: stream.rewrite(h, PUBLIC_BASE), html, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
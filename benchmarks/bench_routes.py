@@ -0,0 +1,220 @@
+"""Load test of every route against local stand-ins.
+
+    python -m benchmarks.bench_routes [--concurrency 16] [--duration 5] [--latency 0.05]
+    python -m benchmarks.bench_routes --server gunicorn --workers 2
+    python -m benchmarks.bench_routes --url http://127.0.0.1:8000 --routes /,/blog
+
+Starts the CMS, S3, SMTP and Mosparo stand-ins from benchmarks.standins,
+serves create_app() against them in a separate process (the werkzeug
+threaded server by default, or gunicorn) and hammers one route at a time
+from `concurrency` keep-alive clients, reporting throughput and latency
+percentiles. With --url an already running site is tested instead; point
+it at `python -m benchmarks.standins` for the upstream calls to work.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmarks.standins import StandIns
+
+MOSPARO_FIELDS = {"_mosparo_submitToken": "bench-submit", "_mosparo_validationToken": "bench-validation"}
+
+# name -> (method, path, form data)
+ROUTES = {
+    "/": ("GET", "/", None),
+    "/blog": ("GET", "/blog", None),
+    "/blog/<slug>": ("GET", "/blog/post-2", None),
+    "/open-day": ("GET", "/open-day", None),
+    "/media (cached)": ("GET", "/media/blog_body_images/photo.jpg", None),
+    "/media (resized)": ("GET", "/media/blog_body_images/photo.jpg?w=640&fm=webp", None),
+    "/media (8 MB, streamed)": ("GET", "/media/blog_body_images/large.bin", None),
+    "POST /contact/": ("POST", "/contact/", {
+        "name": "Bench Mark", "email": "bench@example.org", "subject": "Load test",
+        "message": "Hello from the benchmark suite. " * 20, "privacy": "y", **MOSPARO_FIELDS,
+    }),
+    "POST /safetyreport": ("POST", "/safetyreport", {
+        "name": "", "email": "", "who": "Someone", "when": "Yesterday",
+        "describe": "What happened. " * 40, "resources": "None", "actions": "None",
+        "privacy": "y", **MOSPARO_FIELDS,
+    }),
+}
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve_werkzeug(config: dict, port: int):
+    from werkzeug.serving import make_server
+
+    from hackspace_website import create_app
+
+    import logging
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    make_server("127.0.0.1", port, create_app(test_config=config), threaded=True).serve_forever()
+
+
+def start_server(args, config: dict):
+    """Serve the site in another process, returns (url, stop)."""
+    port = _free_port()
+    if args.server == "werkzeug":
+        process = multiprocessing.get_context("fork").Process(target=_serve_werkzeug, args=(config, port), daemon=True)
+        process.start()
+        stop = process.terminate
+    else:
+        config_path = os.path.join(tempfile.mkdtemp(prefix="hackspace-bench-"), "config.json")
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+        command = [
+            sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}", "-w", str(args.workers),
+            "--log-level", "warning",
+        ]
+        if args.gunicorn_config:
+            command += ["-c", args.gunicorn_config]
+        if args.worker_class:
+            command += ["-k", args.worker_class]
+        process = subprocess.Popen(command + ["benchmarks.wsgi:app"], env={**os.environ, "BENCH_CONFIG": config_path})
+        stop = process.terminate
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url + "/visit", timeout=5)
+            return url, stop
+        except requests.RequestException:
+            # Not listening yet, or still busy starting the app
+            time.sleep(0.1)
+    stop()
+    raise SystemExit(f"The site didn't start on {url}")
+
+
+def run_route(url: str, method: str, path: str, data, concurrency: int, duration: float) -> dict:
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        mine = []
+        codes = {}
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                response = session.request(method, url + path, data=data, timeout=30)
+                response.content  # read the whole body
+                code = response.status_code
+            except requests.RequestException as e:
+                code = type(e).__name__
+            mine.append(time.perf_counter() - start)
+            codes[code] = codes.get(code, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for code, count in codes.items():
+                statuses[code] = statuses.get(code, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else float("nan"),
+        "statuses": statuses,
+    }
+
+
+def print_results(results: dict):
+    print(f"{'route':<26} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}  statuses")
+    for name, r in results.items():
+        print(
+            f"{name:<26} {r['requests']:>9} {r['rps']:>9.1f} {r['p50'] * 1000:>9.1f} {r['p90'] * 1000:>9.1f} "
+            f"{r['p99'] * 1000:>9.1f} {r['max'] * 1000:>9.1f}  {r['statuses']}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Test a running site instead of starting one.")
+    parser.add_argument("--server", choices=("werkzeug", "gunicorn"), default="werkzeug")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--worker-class", help="gunicorn worker class, e.g. gevent")
+    parser.add_argument("--gunicorn-config", help="gunicorn config file, e.g. gunicorn.conf.py")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5, help="Seconds per route.")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds per route before measuring.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each stand-in waits before answering.")
+    parser.add_argument("--config", default="{}", help="JSON object of extra config, e.g. '{\"CMS_PREFETCH\": \"off\"}'")
+    parser.add_argument("--routes", help="Comma separated route names, default all.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args(argv)
+
+    names = args.routes.split(",") if args.routes else list(ROUTES)
+    unknown = [name for name in names if name not in ROUTES]
+    if unknown:
+        parser.error(f"unknown route(s) {unknown}, choose from {list(ROUTES)}")
+
+    standins = None
+    stop = None
+    url = args.url
+    if url is None:
+        standins = StandIns(latency=args.latency)
+        config = {**standins.config, **json.loads(args.config)}
+        url, stop = start_server(args, config)
+        print(f"Serving on {url} ({args.server}), stand-in latency {args.latency * 1000:.0f} ms")
+
+    results = {}
+    try:
+        for name in names:
+            method, path, data = ROUTES[name]
+            if args.warmup:
+                run_route(url, method, path, data, args.concurrency, args.warmup)
+            results[name] = run_route(url, method, path, data, args.concurrency, args.duration)
+    finally:
+        if stop is not None:
+            stop()
+        if standins is not None:
+            standins.close()
+            shutil.rmtree(standins.directory, ignore_errors=True)
+
+    print(f"\n{args.concurrency} concurrent clients, {args.duration:g}s per route\n")
+    print_results(results)
+    if standins is not None and standins.smtp is not None:
+        print(f"\nSMTP stand-in received {len(standins.smtp_received)} message(s)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1, default=str)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Worker cold start: import time, create_app() and time to first response.
+
+    python -m benchmarks.bench_startup [--runs 5] [--paths /,/blog,/blog/post-2]
+
+Every run is a fresh interpreter, like a gunicorn worker booting. The site
+runs against the stand-ins from benchmarks.standins. The first run starts
+with an empty Jinja bytecode cache and the others reuse it. Also shows
+which of the slow to import libraries had been loaded by the end.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = (
+    "boto3", "botocore", "bs4", "lxml", "requests", "mosparo_api_client", "sqlalchemy", "flask_migrate", "PIL",
+    "smtplib",
+)
+
+
+def child(paths: list):
+    started = time.perf_counter()
+    from hackspace_website import create_app
+    imported = time.perf_counter()
+    with open(os.environ["BENCH_CONFIG"]) as f:
+        app = create_app(test_config=json.load(f))
+    created = time.perf_counter()
+
+    client = app.test_client()
+    first = {}
+    for path in paths:
+        start = time.perf_counter()
+        response = client.get(path)
+        first[path] = time.perf_counter() - start
+        if response.status_code != 200:
+            raise SystemExit(f"{path} returned {response.status}")
+    json.dump({
+        "import": imported - started,
+        "create_app": created - imported,
+        "first": first,
+        "modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }, sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--paths", default="/,/blog,/blog/post-2", help="Comma separated, requested in order.")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    paths = args.paths.split(",")
+    if args.child:
+        return child(paths)
+
+    from benchmarks.standins import StandIns
+
+    standins = StandIns(smtp=False)
+    config_path = os.path.join(standins.directory, "config.json")
+    with open(config_path, "w") as f:
+        # No prefetch thread, so each page fetches what it needs itself
+        json.dump({**standins.config, "CMS_PREFETCH": "off"}, f)
+
+    runs = []
+    try:
+        for _ in range(args.runs):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_startup", "--child", "--paths", args.paths],
+                env={**os.environ, "BENCH_CONFIG": config_path},
+                check=True, capture_output=True, text=True,
+            ).stdout
+            runs.append(json.loads(output))
+    finally:
+        standins.close()
+        shutil.rmtree(standins.directory, ignore_errors=True)
+
+    columns = ["import", "create_app"] + [f"first {path}" for path in paths]
+    print(f"{'':<12}" + "".join(f"{c:>20}" for c in columns))
+
+    def row(label, results):
+        values = [
+            statistics.median(r[key] for r in results) for key in ("import", "create_app")
+        ] + [statistics.median(r["first"][path] for r in results) for path in paths]
+        print(f"{label:<12}" + "".join(f"{v * 1000:>18.1f}ms" for v in values))
+
+    row("cold cache", runs[:1])
+    if len(runs) > 1:
+        row("warm cache", runs[1:])
+    print(f"\nLoaded by the end: {', '.join(runs[-1]['modules']) or 'none of ' + ', '.join(HEAVY_MODULES)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Check the streaming lxml rewriter produces byte-identical output to the
+BeautifulSoup one.
+
+    python -m benchmarks.compare_rewriters
+
+Runs both backends over every fixture in benchmarks/fixtures/rewrite plus a
+few generated large posts, feeding the streaming backend in small chunks so
+that chunk boundaries land mid-tag and mid-text. Exits non-zero on any
+difference.
+"""
+from pathlib import Path
+import sys
+
+from benchmarks.bench_rewrite import PUBLIC_BASE, make_post
+from hackspace_website.rewrite import default_pipeline
+
+FIXTURES = Path(__file__).parent / "fixtures" / "rewrite"
+
+
+def corpus():
+    for path in sorted(FIXTURES.glob("*.html")):
+        yield path.name, path.read_text(encoding="utf-8")
+    for images in (10, 200, 1000):
+        yield f"generated-{images}", make_post(images, images // 4, images * 2)
+
+
+# With and without srcset generation for resized media
+VARIANTS = {
+    "": ((), None),
+    " +srcset": ((320, 640, 1280), "(min-width: 1667px) 1600px, 96vw"),
+}
+
+
+def main():
+    failures = 0
+
+    for label, (widths, sizes) in VARIANTS.items():
+        soup = default_pipeline("soup", widths, sizes)
+        stream = default_pipeline("lxml", widths, sizes)
+
+        for name, html in corpus():
+            name += label
+            expected = soup.rewrite(html, PUBLIC_BASE)
+            for chunk_size in (7, 512, len(html)):
+                chunks = (html[i:i + chunk_size] for i in range(0, len(html), chunk_size))
+                actual = "".join(stream.rewrite_iter(chunks, PUBLIC_BASE))
+                if actual.encode() != expected.encode():
+                    failures += 1
+                    print(f"MISMATCH {name} (chunk size {chunk_size})")
+                    print(f"  soup: {expected[:300]!r}")
+                    print(f"  lxml: {actual[:300]!r}")
+                    break
+            else:
+                print(f"ok       {name}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
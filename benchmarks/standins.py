@@ -0,0 +1,357 @@
+"""Local stand-ins for everything the site talks to, for benchmarks.
+
+    python -m benchmarks.standins [--latency 0.05]
+
+starts a fake CMS, S3 bucket, SMTP server and Mosparo, and prints the
+config.toml lines that point the site at them, so a real gunicorn can be
+load-tested with `python -m benchmarks.bench_routes --url ...`. The
+bench_routes script starts its own when run without --url.
+
+Each stand-in waits `latency` seconds before answering to play the part of
+a remote service; they are otherwise as quick as they can be.
+"""
+import argparse
+from email.utils import formatdate
+import hashlib
+import hmac
+import io
+import json
+import os
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from benchmarks.bench_rewrite import make_post
+
+MOSPARO_PUBLIC_KEY = "bench-public"
+MOSPARO_PRIVATE_KEY = "bench-private"
+SMTP_USER = "bench@example.org"
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Lots of concurrent clients in a load test
+    request_queue_size = 512
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b"", content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+def _serve(handler_class, **attrs) -> ThreadingHTTPServer:
+    handler = type(handler_class.__name__, (handler_class,), attrs)
+    server = _Server(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CmsHandler(_Handler):
+    # Django CMS API: the blog list, post details and the open day page
+    latency = 0.0
+    posts = {}
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["api", "blog"]:
+            summaries = [{k: v for k, v in post.items() if k != "body_html"} for post in self.posts.values()]
+            query = parse_qs(url.query)
+            if "page" in query:
+                page, size = int(query["page"][0]), int(query.get("page_size", ["10"])[0])
+                more = page * size < len(summaries)
+                body = {
+                    "count": len(summaries),
+                    "next": f"http://{self.headers['Host']}/api/blog/?page={page + 1}&page_size={size}" if more else None,
+                    "previous": None,
+                    "results": summaries[(page - 1) * size:page * size],
+                }
+            else:
+                body = summaries
+        elif len(parts) == 3 and parts[:2] == ["api", "blog"] and parts[2] in self.posts:
+            body = self.posts[parts[2]]
+        elif parts[:2] == ["api", "open-day"]:
+            body = {
+                "title": "Open day", "date": "2026-11-07", "start_time": "11:00", "end_time": "16:00",
+                "description": "Come and see the space.", "accessibility_note": "Step-free access.",
+            }
+        else:
+            return self._send(404, b'{"detail": "Not found."}')
+        self._send(200, json.dumps(body).encode())
+
+
+def make_posts(count: int) -> dict:
+    # A mix of short news items and long build logs full of photos
+    sizes = [(2, 1, 8), (10, 2, 40), (40, 5, 120)]
+    posts = {}
+    for i in range(count):
+        images, links, paragraphs = sizes[i % len(sizes)]
+        slug = f"post-{i}"
+        posts[slug] = {
+            "slug": slug,
+            "title": f"Build log {i}",
+            "subtitle": "What we've been up to",
+            "author": "Bench Mark",
+            "publish_date": "2026-01-01",
+            "intro_text": "A short introduction to the post.",
+            "main_image_url": f"/media/blog_main_images/photo_{i}.jpg",
+            "body_html": make_post(images, links, paragraphs),
+        }
+    return posts
+
+
+class S3Handler(_Handler):
+    # Path-style GetObject/HeadObject with ETags and single ranges
+    latency = 0.0
+    objects = {}
+
+    def _object(self):
+        path = unquote(urlsplit(self.path).path).lstrip("/")
+        _, _, key = path.partition("/")
+        return self.objects.get(key)
+
+    def _error(self, code: str, status: int):
+        body = f'<?xml version="1.0"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'.encode()
+        self._send(status, body, "application/xml")
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        obj = self._object()
+        if obj is None:
+            return self._error("NoSuchKey", 404)
+        data, content_type, mtime = obj
+        headers = {
+            "ETag": '"%s"' % hashlib.md5(data).hexdigest(),
+            "Last-Modified": formatdate(mtime, usegmt=True),
+            "Accept-Ranges": "bytes",
+        }
+        if self.headers.get("If-None-Match") == headers["ETag"]:
+            self.send_response(304)
+            self.send_header("ETag", headers["ETag"])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            start, _, end = byte_range[len("bytes="):].partition("-")
+            start = int(start or 0)
+            end = min(int(end) if end else len(data) - 1, len(data) - 1)
+            if start >= len(data):
+                return self._error("InvalidRange", 416)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            return self._send(206, data[start:end + 1], content_type, headers)
+        self._send(200, data, content_type, headers)
+
+
+def make_image(width: int, height: int) -> bytes:
+    from PIL import Image
+    out = io.BytesIO()
+    Image.linear_gradient("L").resize((width, height)).convert("RGB").save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+class MosparoHandler(_Handler):
+    # Accepts every submission, signed the way the real server does it
+    latency = 0.0
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        signature = hmac.new(
+            MOSPARO_PRIVATE_KEY.encode(),
+            (request["validationSignature"] + request["formSignature"]).encode(),
+            hashlib.sha256,
+        ).hexdigest()
+        body = {"valid": True, "verificationSignature": signature, "verifiedFields": {}, "issues": []}
+        self._send(200, json.dumps(body).encode())
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    # Just enough ESMTP over implicit TLS for smtplib.SMTP_SSL to log in and
+    # send; messages are counted and thrown away.
+    latency = 0.0
+    received = None
+
+    def _reply(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self._reply("220 bench ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-bench\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif verb == "AUTH":
+                self._reply("235 2.7.0 Authentication successful")
+            elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                time.sleep(self.latency)
+                self.received.append(time.time())
+                self._reply("250 OK queued")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+class _TLSServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, context):
+        super().__init__(address, handler)
+        self.context = context
+
+    def get_request(self):
+        sock, address = super().get_request()
+        return self.context.wrap_socket(sock, server_side=True), address
+
+
+def _self_signed_cert(directory: str) -> tuple[str, str]:
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+         "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+class StandIns:
+    """Starts every stand-in; `config` points create_app at them."""
+
+    def __init__(self, latency: float = 0.0, posts: int = 30, smtp: bool = True):
+        self.directory = tempfile.mkdtemp(prefix="hackspace-bench-")
+        self.posts = make_posts(posts)
+        self.objects = {
+            "media/blog_body_images/photo.jpg": (make_image(1600, 1200), "image/jpeg", time.time() - 3600),
+            "media/blog_body_images/large.bin": (os.urandom(8 * 1024 * 1024), "application/octet-stream", time.time() - 3600),
+        }
+        self.smtp_received = []
+        self.cms = _serve(CmsHandler, latency=latency, posts=self.posts)
+        self.s3 = _serve(S3Handler, latency=latency, objects=self.objects)
+        self.mosparo = _serve(MosparoHandler, latency=latency)
+        self.smtp = None
+        if smtp:
+            try:
+                cert, key = _self_signed_cert(self.directory)
+            except (OSError, subprocess.CalledProcessError):
+                print("openssl isn't available, not starting the SMTP stand-in")
+            else:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                context.load_cert_chain(cert, key)
+                handler = type("SmtpHandler", (SmtpHandler,), {"latency": latency, "received": self.smtp_received})
+                self.smtp = _TLSServer(("127.0.0.1", 0), handler, context)
+                threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+                # The mailer verifies certificates against the default store,
+                # which honours this
+                os.environ["SSL_CERT_FILE"] = cert
+
+    def url(self, server) -> str:
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    @property
+    def config(self) -> dict:
+        cms = self.url(self.cms)
+        config = {
+            "SECRET_KEY": "bench",
+            "TIMEZONE": "Europe/London",
+            "CMS_BASE_URL": cms,
+            "CMS_OPEN_DAY_URL": cms + "/api/open-day/1/",
+            "CMS_BLOG_LIST_URL": cms + "/api/blog/",
+            "CMS_BLOG_DETAIL_URL": cms + "/api/blog/{slug}/",
+            "PUBLIC_MEDIA_URL": "/media/",
+            "AWS_STORAGE_BUCKET_NAME": "bench",
+            "AWS_S3_ENDPOINT_URL": self.url(self.s3),
+            "AWS_ACCESS_KEY_ID": "bench",
+            "AWS_SECRET_ACCESS_KEY": "bench",
+            "MOSPARO_ENABLED": True,
+            "MOSPARO_HOST": self.url(self.mosparo),
+            "MOSPARO_UUID": "bench",
+            "MOSPARO_PUBLIC_KEY": MOSPARO_PUBLIC_KEY,
+            "MOSPARO_PRIVATE_KEY": MOSPARO_PRIVATE_KEY,
+            # Every request comes from the same address in a load test
+            "RATELIMIT_ENABLED": False,
+            "WTF_CSRF_ENABLED": False,
+            "MEDIA_CACHE_DIR": os.path.join(self.directory, "media-cache"),
+            "MAIL_SPOOL_PATH": os.path.join(self.directory, "mail_spool.sqlite3"),
+            "PAGE_CACHE_DIR": os.path.join(self.directory, "page-cache"),
+            "ASSETS_DIR": os.path.join(self.directory, "assets"),
+            "EXPORT_DIR": os.path.join(self.directory, "export"),
+            "CMS_INVALIDATION_PATH": os.path.join(self.directory, "cms_invalidations.sqlite3"),
+            "RATELIMIT_PATH": os.path.join(self.directory, "ratelimit.sqlite3"),
+            "JINJA_BYTECODE_CACHE_DIR": os.path.join(self.directory, "jinja-cache"),
+        }
+        if self.smtp is not None:
+            config.update({
+                "SMTP_SERVER": "127.0.0.1",
+                "SMTP_PORT": self.smtp.server_address[1],
+                "SMTP_EMAIL": SMTP_USER,
+                "SMTP_PASSWORD": "bench",
+            })
+        return config
+
+    def close(self):
+        for server in (self.cms, self.s3, self.mosparo, self.smtp):
+            if server is not None:
+                server.shutdown()
+
+
+def _toml_value(value) -> str:
+    return json.dumps(value)  # close enough for strings, numbers and booleans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each stand-in waits before answering.")
+    parser.add_argument("--posts", type=int, default=30)
+    args = parser.parse_args()
+
+    standins = StandIns(args.latency, args.posts)
+    print("# config.toml for the stand-ins")
+    for key, value in standins.config.items():
+        print(f"{key} = {_toml_value(value)}")
+    if standins.smtp is not None:
+        print(f"\n# and start the server with SSL_CERT_FILE={os.environ['SSL_CERT_FILE']}")
+    print("\nRunning, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        standins.close()
+
+
+if __name__ == "__main__":
+    main()
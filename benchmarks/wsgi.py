@@ -0,0 +1,14 @@
+"""WSGI entry point for serving the site against the benchmark stand-ins.
+
+    BENCH_CONFIG=/tmp/config.json gunicorn benchmarks.wsgi:app
+
+bench_routes writes the JSON config and starts gunicorn this way; config.toml
+in the instance folder isn't read.
+"""
+import json
+import os
+
+from hackspace_website import create_app
+
+with open(os.environ["BENCH_CONFIG"]) as f:
+    app = create_app(test_config=json.load(f))
@@ -0,0 +1,43 @@
+# gunicorn reads this from the working directory on start; command line
+# options still win.
+#
+# Nearly all the time a request takes is spent waiting on something else:
+# the CMS, the S3 bucket, Mosparo or the mail server. With the default sync
+# workers each of those waits ties up a whole worker, so a couple of slow
+# upstream calls are enough to queue every other visitor.
+#
+# GUNICORN_WORKER_CLASS=gthread with GUNICORN_THREADS > 1 (what the
+# container runs) gives each worker a pool of threads, so one waiting
+# request doesn't hold up the rest and blocking calls only block their own
+# thread.
+#
+# GUNICORN_WORKER_CLASS=gevent is opt-in and goes further, running requests
+# on greenlets so one worker can have hundreds of upstream calls in flight.
+# It only helps with what gevent can patch, though: the rate limiter,
+# invalidation log, mail spool and SQLite CMS cache wait on SQLite locks in
+# C, which freezes every greenlet in the worker until the lock is free, and
+# their per-thread connections become per-greenlet, i.e. one per request.
+# Use it with the memory backends and RATELIMIT_BACKEND = "memory", or if
+# those files see little contention.
+import os
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+# Requests per gthread worker, gunicorn switches sync workers to gthread
+# when this is above 1
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+# Concurrent requests per gevent worker
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "500"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+
+
+def post_fork(server, worker):
+    if worker_class != "gevent":
+        return
+    # psycopg2 waits on the database in C where gevent can't see it, so
+    # without this a slow query stalls every request on the worker
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+    patch_psycopg()
@@ -0,0 +1,300 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError:  # only gzip siblings without it
+    brotli = None
+
+from hackspace_website import media_variants
+from hackspace_website.page_cache import write_atomic
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+
+# Already compressed formats (fonts, photos) gain nothing from gzip
+COMPRESS_EXTENSIONS = {".css", ".js", ".svg", ".ico", ".txt", ".json", ".xml"}
+
+IMAGE_EXTENSIONS = {".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png"}
+MAX_PIXELS = 50_000_000
+
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+CSS_STRING_RE = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')""")
+CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+
+
+def minify_css(css: str) -> str:
+    """Drop comments and whitespace that doesn't mean anything. Quoted
+    strings are left exactly as they are."""
+    css = CSS_COMMENT_RE.sub("", css)
+    parts = CSS_STRING_RE.split(css)
+    for i in range(0, len(parts), 2):  # odd indexes are the strings
+        part = re.sub(r"\s+", " ", parts[i])
+        part = re.sub(r"\s*([{};,>])\s*", r"\1", part)
+        # Only after a colon, before one it may be a descendant selector
+        part = re.sub(r":\s+", ":", part)
+        parts[i] = part.replace(";}", "}")
+    return "".join(parts).strip()
+
+
+def _hashed_name(name: str, data: bytes, suffix: str = "") -> str:
+    root, ext = posixpath.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return f"{root}{suffix}.{digest}{ext}"
+
+
+class AssetBuilder:
+    """Copies the static folder into `output` under content-hashed names,
+    which can then be cached forever.
+
+    Stylesheets are minified and their url()s pointed at the hashed files,
+    text files get .gz/.br siblings and JPEG/PNG images are re-encoded,
+    with smaller versions in `widths` for srcset. Hashed files are never
+    removed by a build, so pages still cached somewhere keep working.
+    """
+
+    def __init__(self, source: str, output: str, widths=(), formats=(), quality: int = 80):
+        self.source = source
+        self.output = output
+        self.widths = widths
+        self.formats = formats
+        self.quality = quality
+        self.files = {}
+        self.variants = {}
+        self.compressed = {}
+        self.written = 0
+
+    def _write(self, name: str, data: bytes, compress: bool = False):
+        path = os.path.join(self.output, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            # Same name means same content, so only new files need writing.
+            # Written to a temp file first, as a half-written one would
+            # never be replaced and is served as immutable.
+            write_atomic(path, data)
+            self.written += 1
+        if not compress:
+            return
+        encodings = {"gzip": lambda: gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            encodings["br"] = lambda: brotli.compress(data, quality=11)
+        available = []
+        for encoding, encode in encodings.items():
+            sibling = path + (".br" if encoding == "br" else ".gz")
+            if not os.path.exists(sibling):
+                encoded = encode()
+                if len(encoded) >= len(data):
+                    continue
+                write_atomic(sibling, encoded)
+            available.append(encoding)
+        if available:
+            self.compressed[name] = available
+
+    def _add_image(self, name: str, path: str, fmt: str, data: bytes) -> bytes:
+        # Re-encoding usually shaves a good part off photos straight from a
+        # camera or CMS export. Keep the original if it doesn't.
+        try:
+            width = media_variants.image_width(path)
+            optimized = media_variants.render(path, width, fmt, self.quality, MAX_PIXELS)
+            if len(optimized) < len(data):
+                data = optimized
+
+            variants = []
+            root = posixpath.splitext(name)[0]
+            for variant_fmt in dict.fromkeys((fmt, *self.formats)):
+                if not media_variants.can_encode(variant_fmt):
+                    continue
+                ext = "." + ("jpg" if variant_fmt == "jpeg" else variant_fmt)
+                for variant_width in sorted({w for w in self.widths if w < width} | {width}):
+                    if variant_fmt == fmt and variant_width == width:
+                        # The image itself, its name is filled in by build()
+                        variants.append({"format": fmt, "width": width, "file": None})
+                        continue
+                    encoded = media_variants.render(path, variant_width, variant_fmt, self.quality, MAX_PIXELS)
+                    variant = _hashed_name(root + ext, encoded, f"-{variant_width}w")
+                    self._write(variant, encoded)
+                    variants.append({"format": variant_fmt, "width": variant_width, "file": variant})
+        except (OSError, ValueError):
+            logger.warning("Could not optimize %s, copying it as is", name, exc_info=True)
+            return data
+        self.variants[name] = variants
+        return data
+
+    def _rewrite_css_urls(self, name: str, css: str) -> str:
+        directory = posixpath.dirname(name)
+
+        def replace(match):
+            url = match.group(2).strip()
+            if url.startswith(("data:", "#", "/")) or "://" in url:
+                return match.group(0)
+            path, suffix = re.match(r"([^?#]*)(.*)", url).groups()
+            target = posixpath.normpath(posixpath.join(directory, path))
+            if target not in self.files:
+                logger.warning("%s refers to %s, which isn't a static file", name, url)
+                return match.group(0)
+            hashed = posixpath.relpath(self.files[target], directory or ".")
+            return f"url('{hashed}{suffix}')"
+
+        return CSS_URL_RE.sub(replace, css)
+
+    def build(self) -> dict:
+        names = []
+        for root, _, files in os.walk(self.source):
+            for filename in files:
+                path = os.path.join(root, filename)
+                names.append(os.path.relpath(path, self.source).replace(os.sep, "/"))
+        # Stylesheets last, they need the hashed names of what they refer to
+        names.sort(key=lambda n: (n.endswith(".css"), n))
+
+        for name in names:
+            path = os.path.join(self.source, *name.split("/"))
+            ext = posixpath.splitext(name)[1].lower()
+            with open(path, "rb") as f:
+                data = f.read()
+            if ext == ".css":
+                data = minify_css(self._rewrite_css_urls(name, data.decode())).encode()
+            elif ext in IMAGE_EXTENSIONS and media_variants.available():
+                data = self._add_image(name, path, IMAGE_EXTENSIONS[ext], data)
+            hashed = _hashed_name(name, data)
+            self._write(hashed, data, compress=ext in COMPRESS_EXTENSIONS)
+            self.files[name] = hashed
+            for variant in self.variants.get(name, ()):
+                variant["file"] = variant["file"] or hashed
+
+        manifest = {"files": self.files, "variants": self.variants, "compressed": self.compressed}
+        write_atomic(os.path.join(self.output, MANIFEST), json.dumps(manifest, indent=1).encode())
+        return manifest
+
+
+class Assets:
+    """Serves the output of `flask assets build`. Loaded once at startup;
+    without a build, static files are served from the static folder as
+    usual."""
+
+    def __init__(self, app, directory: str):
+        self.app = app
+        self.directory = directory
+        self.files = {}
+        self.variants = {}
+        self.compressed = {}
+        self.hashed = set()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST)
+
+    def load(self) -> bool:
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            logger.warning("Ignoring corrupt asset manifest %s", self.manifest_path)
+            return False
+        self.files = manifest["files"]
+        self.variants = manifest["variants"]
+        self.compressed = manifest["compressed"]
+        self.hashed = set(self.files.values()) | {
+            v["file"] for variants in self.variants.values() for v in variants
+        }
+        return True
+
+    def url_defaults(self, endpoint: str, values: dict):
+        # url_for("static", filename="css/style.css") -> the hashed copy
+        if endpoint == "static" and values.get("filename") in self.files:
+            values["filename"] = self.files[values["filename"]]
+
+    def serve(self, filename: str):
+        if filename not in self.hashed:
+            return self.app.send_static_file(filename)
+
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encoding = None
+        for candidate in ("br", "gzip"):
+            if candidate in self.compressed.get(filename, ()) and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        if encoding is None:
+            response = send_from_directory(self.directory, filename, mimetype=mimetype, max_age=None)
+        else:
+            sibling = filename + (".br" if encoding == "br" else ".gz")
+            response = send_from_directory(self.directory, sibling, mimetype=mimetype, max_age=None)
+            response.content_encoding = encoding
+        if filename in self.compressed:
+            response.vary.add("Accept-Encoding")
+        # The name changes whenever the content does
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+        return response
+
+    def srcset(self, filename: str, fmt: str | None = None) -> str:
+        variants = self.variants.get(filename, ())
+        if fmt is None and variants:
+            fmt = variants[0]["format"]
+        return ", ".join(
+            f"{url_for('static', filename=v['file'])} {v['width']}w"
+            for v in variants if v["format"] == fmt
+        )
+
+
+def static_srcset(filename: str, fmt: str | None = None) -> str:
+    """srcset for a static image built with widths, empty without a build."""
+    assets = current_app.extensions.get("assets")
+    return assets.srcset(filename, fmt) if assets is not None else ""
+
+
+assets_cli = AppGroup("assets", help="Fingerprinted static files.")
+
+
+@assets_cli.command("build")
+@click.option("--clean", is_flag=True, help="Remove the output of earlier builds first.")
+def build_command(clean):
+    """Hash, minify and compress the static folder into ASSETS_DIR."""
+    assets = current_app.extensions.get("assets")
+    if assets is None:
+        raise click.ClickException("ASSETS_ENABLED is off")
+    if clean:
+        shutil.rmtree(assets.directory, ignore_errors=True)
+    os.makedirs(assets.directory, exist_ok=True)
+
+    cfg = current_app.config
+    builder = AssetBuilder(
+        current_app.static_folder,
+        assets.directory,
+        widths=cfg["ASSETS_IMAGE_WIDTHS"],
+        formats=cfg["ASSETS_IMAGE_FORMATS"],
+        quality=cfg["ASSETS_IMAGE_QUALITY"],
+    )
+    manifest = builder.build()
+    assets.load()
+    click.echo(
+        f"Built {len(manifest['files'])} asset(s) into {assets.directory}, {builder.written} new file(s)"
+    )
+
+
+def init_app(app):
+    app.cli.add_command(assets_cli)
+    app.add_template_global(static_srcset)
+    if not app.config["ASSETS_ENABLED"]:
+        return
+    assets = Assets(app, app.config.get("ASSETS_DIR") or os.path.join(app.instance_path, "assets"))
+    app.extensions["assets"] = assets
+    if assets.load():
+        app.logger.debug("Serving %d built asset(s) from %s", len(assets.files), assets.directory)
+    app.url_defaults(assets.url_defaults)
+    app.view_functions["static"] = assets.serve
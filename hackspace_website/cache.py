@@ -0,0 +1,119 @@
+from collections import OrderedDict
+import threading
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Small thread-safe mapping that evicts the least recently used entry
+    once it holds more than `maxsize` items.
+
+    If `maxweight` is given each value is measured with `weigh` (len by
+    default) and entries are also evicted to keep the total under it.
+    """
+
+    def __init__(self, maxsize: int = 128, maxweight: int | None = None, weigh=len):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if self.maxweight is not None:
+                size = self.weigh(value)
+                if size > self.maxweight:
+                    return
+                self.weight += size
+            self._data[key] = value
+            while len(self._data) > self.maxsize or (
+                self.maxweight is not None and self.weight > self.maxweight
+            ):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def items(self) -> list:
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def _remove(self, key):
+        value = self._data.pop(key)
+        if self.maxweight is not None:
+            self.weight -= self.weigh(value)
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one.
+
+    The first caller runs `fn`; anyone arriving while it is in progress waits
+    and gets the same result (or exception). `do` returns the result and
+    whether it was shared.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
@@ -0,0 +1,399 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+
+from hackspace_website import metrics
+from hackspace_website.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    # Per-process store, each gunicorn worker keeps its own copy.
+
+    def __init__(self, max_entries: int):
+        self._entries = LRUCache(maxsize=max_entries)
+        # Prefetched content and its bookkeeping, kept out of the LRU so a
+        # big archive can't evict itself. Bounded by what's published.
+        self._pinned = {}
+
+    def get(self, url: str):
+        entry = self._pinned.get(url)
+        return entry if entry is not None else self._entries.get(url)
+
+    def set(self, url: str, value, stored_at: float, pinned: bool = False):
+        if pinned or url in self._pinned:
+            self._pinned[url] = (value, stored_at)
+            self._entries.pop(url)
+        else:
+            self._entries.set(url, (value, stored_at))
+
+    def delete(self, url: str):
+        self._pinned.pop(url, None)
+        self._entries.pop(url)
+
+    def clear(self):
+        self._pinned.clear()
+        self._entries.clear()
+
+
+class SQLiteBackend:
+    # Store shared by every worker on the box. Rows are trimmed by last access
+    # so the file stays bounded like the in-memory LRU, pinned ones live in
+    # their own table that isn't.
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cms_cache ("
+                "url TEXT PRIMARY KEY, body TEXT NOT NULL, "
+                "stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_cms_cache_accessed_at ON cms_cache (accessed_at)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cms_pinned ("
+                "url TEXT PRIMARY KEY, body TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, url: str):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT body, stored_at FROM cms_pinned WHERE url = ?", (url,)
+        ).fetchone()
+        if row is not None:
+            return json.loads(row[0]), row[1]
+        row = conn.execute(
+            "SELECT body, stored_at FROM cms_cache WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE cms_cache SET accessed_at = ? WHERE url = ?", (time.time(), url))
+        return json.loads(row[0]), row[1]
+
+    def set(self, url: str, value, stored_at: float, pinned: bool = False):
+        conn = self._connect()
+        body = json.dumps(value)
+        if pinned:
+            conn.execute(
+                "INSERT OR REPLACE INTO cms_pinned (url, body, stored_at) VALUES (?, ?, ?)",
+                (url, body, stored_at),
+            )
+            conn.execute("DELETE FROM cms_cache WHERE url = ?", (url,))
+            return
+        if conn.execute(
+            "UPDATE cms_pinned SET body = ?, stored_at = ? WHERE url = ?", (body, stored_at, url)
+        ).rowcount:
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO cms_cache (url, body, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (url, body, stored_at, time.time()),
+        )
+        conn.execute(
+            "DELETE FROM cms_cache WHERE url IN ("
+            "SELECT url FROM cms_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def delete(self, url: str):
+        conn = self._connect()
+        conn.execute("DELETE FROM cms_pinned WHERE url = ?", (url,))
+        conn.execute("DELETE FROM cms_cache WHERE url = ?", (url,))
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM cms_pinned")
+        conn.execute("DELETE FROM cms_cache")
+
+
+class CmsCache:
+    """TTL cache in front of the CMS API.
+
+    Fresh entries are served directly. Once an entry is older than its TTL it is
+    still served for up to `stale_ttl` seconds while a background thread
+    refetches it. Past that the fetch happens inline, and if the CMS is down
+    whatever copy we have is served instead of an error.
+    """
+
+    def __init__(self, backend, fetch, ttls: dict, default_ttl: float, stale_ttl: float):
+        self.backend = backend
+        self.fetch = fetch
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, url: str, endpoint: str):
+        entry = self.backend.get(url)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.time() - stored_at
+            ttl = self.ttls.get(endpoint, self.default_ttl)
+            if age < ttl:
+                return value
+            if age < ttl + self.stale_ttl:
+                self._refresh_in_background(url)
+                return value
+
+        try:
+            return self._fetch_and_store(url)
+        except Exception:
+            if entry is None:
+                raise
+            logger.warning("CMS fetch failed for %s, serving stale copy", url, exc_info=True)
+            return entry[0]
+
+    def peek(self, url: str):
+        # Whatever is stored, however old, without ever fetching
+        entry = self.backend.get(url)
+        return entry[0] if entry is not None else None
+
+    def store(self, url: str, value, pinned: bool = False):
+        # Pinned entries are never evicted, only replaced or invalidated.
+        # Storing over one keeps it pinned.
+        self.backend.set(url, value, time.time(), pinned)
+
+    def invalidate(self, url: str):
+        self.backend.delete(url)
+
+    def _fetch_and_store(self, url: str):
+        value = self.fetch(url)
+        self.backend.set(url, value, time.time())
+        return value
+
+    def _refresh_in_background(self, url: str):
+        with self._lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+
+        def refresh():
+            try:
+                self._fetch_and_store(url)
+            except Exception:
+                logger.warning("Background CMS refresh failed for %s", url, exc_info=True)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(url)
+
+        threading.Thread(target=refresh, name="cms-refresh", daemon=True).start()
+
+
+class InvalidationLog:
+    """Tells every worker which cache keys to drop.
+
+    The memory backend lives in each worker, so when one of them handles an
+    invalidation it appends the keys to a small SQLite table and the others
+    pick them up on their next request (checked at most every
+    `poll_interval` seconds). "*" means drop everything.
+    """
+
+    KEEP_FOR = 24 * 60 * 60
+
+    def __init__(self, path: str, poll_interval: float):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._own = set()
+        self._last_poll = time.monotonic()
+        # Set when the file is first opened, by the first request or publish
+        # rather than create_app so CLI commands and scripts never touch it
+        self._last_id = None
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        if self._last_id is None:
+            with self._lock:
+                if self._last_id is None:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS cms_invalidations ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, created_at REAL NOT NULL)"
+                    )
+                    # The cache starts out empty, so only later entries matter
+                    self._last_id = conn.execute(
+                        "SELECT COALESCE(MAX(id), 0) FROM cms_invalidations"
+                    ).fetchone()[0]
+        return conn
+
+    def publish(self, keys):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = [
+                conn.execute(
+                    "INSERT INTO cms_invalidations (key, created_at) VALUES (?, ?)", (key, now)
+                ).lastrowid
+                for key in keys
+            ]
+            conn.execute("DELETE FROM cms_invalidations WHERE created_at < ?", (now - self.KEEP_FOR,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            # We've already applied these ourselves
+            self._own.update(ids)
+
+    def poll(self) -> list:
+        if self._last_id is None:
+            # First request, start from here
+            self._connect()
+            return []
+        with self._lock:
+            if time.monotonic() - self._last_poll < self.poll_interval:
+                return []
+            self._last_poll = time.monotonic()
+            last_id = self._last_id
+
+        rows = self._connect().execute(
+            "SELECT id, key FROM cms_invalidations WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+        if not rows:
+            return []
+        with self._lock:
+            self._last_id = max(self._last_id, rows[-1][0])
+            keys = [key for id_, key in rows if id_ not in self._own]
+            self._own.difference_update(id_ for id_, _ in rows)
+        return keys
+
+
+class CmsClient:
+    # One keep-alive session per worker so CMS calls reuse pooled connections
+    # instead of doing a fresh TCP/TLS handshake every page view.
+
+    def __init__(self, pool_size: int, retries: int, backoff: float,
+                 connect_timeout: float, read_timeout: float):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _make_session(self):
+        # Imported here so workers that are only asked for cached pages
+        # never load requests
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Accept"] = "application/json"
+        return session
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._make_session()
+        return self._session
+
+    def get_json(self, url: str):
+        with metrics.span("cms"):
+            resp = self.session.get(url, timeout=self.timeout)
+            resp.raise_for_status()
+            return resp.json()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+def init_app(app):
+    cfg = app.config
+    client = CmsClient(
+        pool_size=cfg["CMS_POOL_SIZE"],
+        retries=cfg["CMS_RETRIES"],
+        backoff=cfg["CMS_RETRY_BACKOFF"],
+        connect_timeout=cfg["CMS_CONNECT_TIMEOUT"],
+        read_timeout=cfg["CMS_READ_TIMEOUT"],
+    )
+    app.extensions["cms_client"] = client
+
+    max_entries = cfg["CMS_CACHE_MAX_ENTRIES"]
+    if cfg["CMS_CACHE_BACKEND"] == "sqlite":
+        path = cfg.get("CMS_CACHE_PATH") or os.path.join(app.instance_path, "cms_cache.sqlite3")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        backend = SQLiteBackend(path, max_entries)
+    else:
+        backend = MemoryBackend(max_entries)
+
+    if cfg["CMS_CACHE_BACKEND"] != "sqlite":
+        # The SQLite backend is already shared, only per-worker caches need telling
+        path = cfg.get("CMS_INVALIDATION_PATH") or os.path.join(app.instance_path, "cms_invalidations.sqlite3")
+        app.extensions["cms_invalidations"] = InvalidationLog(path, cfg["CMS_INVALIDATION_POLL_INTERVAL"])
+        app.before_request(apply_invalidations)
+
+    app.extensions["cms_cache"] = CmsCache(
+        backend,
+        client.get_json,
+        ttls=cfg["CMS_CACHE_TTL"],
+        default_ttl=cfg["CMS_CACHE_DEFAULT_TTL"],
+        stale_ttl=cfg["CMS_CACHE_STALE_TTL"],
+    )
+
+
+def get_json(url: str, endpoint: str):
+    return current_app.extensions["cms_cache"].get(url, endpoint)
+
+
+def _drop(cache: CmsCache, keys):
+    for key in keys:
+        if key == "*":
+            cache.backend.clear()
+        else:
+            cache.invalidate(key)
+
+
+def invalidate(keys):
+    """Drop `keys` from the CMS cache in this worker and all the others."""
+    _drop(current_app.extensions["cms_cache"], keys)
+    log = current_app.extensions.get("cms_invalidations")
+    if log is not None:
+        log.publish(keys)
+
+
+def apply_invalidations():
+    keys = current_app.extensions["cms_invalidations"].poll()
+    if keys:
+        _drop(current_app.extensions["cms_cache"], keys)
@@ -0,0 +1,220 @@
+import hashlib
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_set_header
+
+try:
+    import brotli
+except ImportError:  # gzip only without it
+    brotli = None
+
+from hackspace_website.cache import LRUCache
+
+# Bodies up to this size are read whole and compressed in one go (and can
+# be cached), anything longer is compressed as it streams
+BUFFER_BYTES = 1024 * 1024
+
+# Never worth it, or not allowed to change the body
+SKIP_STATUSES = {204, 206, 304}
+
+
+class CompressionMiddleware:
+    """Compresses text responses with brotli or gzip, whichever the client
+    prefers of the two.
+
+    Responses that already have a Content-Encoding (the page cache and built
+    assets come pre-compressed), ranges, hand-offs to the front server and
+    anything that isn't text are passed through untouched, with the app's
+    own iterable so file responses can still use sendfile(). Bodies that
+    fit in BUFFER_BYTES are compressed whole and, unless they're private or
+    set a cookie, the result is cached by a hash of the body, so pages that
+    come out the same for everyone are only compressed once per worker.
+    """
+
+    def __init__(self, app, min_size: int, gzip_level: int, brotli_quality: int,
+                 mimetypes, cache_max_bytes: int):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.mimetypes = frozenset(mimetypes)
+        self.encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+        self.cache = LRUCache(maxsize=1024, maxweight=cache_max_bytes, weigh=len)
+
+    def __call__(self, environ, start_response):
+        accepted = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING"))
+        encoding = next((e for e in self.encodings if accepted[e]), None)
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return _no_write
+
+        app_iter = self.app(environ, capture)
+        if captured:
+            status, headers, exc_info = captured
+            captured[1] = headers = Headers(headers)
+            if not self._compressible(status, headers, encoding):
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                return app_iter
+            if environ["REQUEST_METHOD"] == "HEAD":
+                # Same headers a GET would get, short of the compressed
+                # length which would take rendering and compressing the body
+                self._encoded_headers(headers, encoding)
+                headers.pop("Content-Length", None)
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                return app_iter
+        # An app that only starts the response once iterated is decided on
+        # after its first chunk
+        return self._compress(app_iter, captured, encoding, start_response)
+
+    def _compressible(self, status: str, headers: Headers, encoding: str | None) -> bool:
+        code = int(status.split(None, 1)[0])
+        if code < 200 or code in SKIP_STATUSES:
+            return False
+        if any(name in headers for name in ("Content-Encoding", "Content-Range", "X-Accel-Redirect", "X-Sendfile")):
+            return False
+        if "no-transform" in headers.get("Cache-Control", ""):
+            return False
+        mimetype = headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+        if not (mimetype.startswith("text/") or mimetype in self.mimetypes):
+            return False
+
+        # Whether or not this client gets it compressed, the next one might
+        vary = parse_set_header(headers.get("Vary"))
+        if "*" not in vary and "accept-encoding" not in {v.lower() for v in vary}:
+            vary.add("Accept-Encoding")
+            headers["Vary"] = vary.to_header()
+        if encoding is None:
+            return False
+        length = headers.get("Content-Length", type=int)
+        return length is None or length >= self.min_size
+
+    def _compress(self, app_iter, captured: list, encoding: str | None, start_response):
+        try:
+            chunks = iter(app_iter)
+            buffered = []
+            size = 0
+            done = False
+            while size < BUFFER_BYTES:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    done = True
+                    break
+                buffered.append(chunk)
+                size += len(chunk)
+                if captured and not isinstance(captured[1], Headers):
+                    break
+
+            if not captured:
+                raise RuntimeError("The app returned without starting the response")
+            status, headers, exc_info = captured
+            if not isinstance(headers, Headers):
+                captured[1] = headers = Headers(headers)
+                if not self._compressible(status, headers, encoding):
+                    start_response(status, headers.to_wsgi_list(), exc_info)
+                    yield from buffered
+                    yield from chunks
+                    return
+                # Worth compressing after all, read on as usual
+                while not done and size < BUFFER_BYTES:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        done = True
+                        break
+                    buffered.append(chunk)
+                    size += len(chunk)
+
+            if done and size < self.min_size:
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                yield from buffered
+                return
+
+            self._encoded_headers(headers, encoding)
+            if done:
+                body = self._compress_whole(b"".join(buffered), encoding, headers)
+                headers["Content-Length"] = str(len(body))
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                yield body
+                return
+
+            headers.pop("Content-Length", None)
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            compress, flush = self._compressor(encoding)
+            for chunk in buffered:
+                yield compress(chunk)
+            for chunk in chunks:
+                if chunk:
+                    # Flushed every chunk so a slow generator still streams
+                    yield compress(chunk) + flush()
+            yield flush(final=True)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+    def _encoded_headers(self, headers: Headers, encoding: str):
+        headers["Content-Encoding"] = encoding
+        headers.pop("Accept-Ranges", None)  # ranges of the identity body
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            # Same content, different bytes. Weak ETags still match
+            # If-None-Match, so revalidation keeps working.
+            headers["ETag"] = "W/" + etag
+
+    def _compress_whole(self, body: bytes, encoding: str, headers: Headers) -> bytes:
+        cache_control = headers.get("Cache-Control", "")
+        cacheable = "Set-Cookie" not in headers and "private" not in cache_control and "no-store" not in cache_control
+        key = (encoding, hashlib.sha256(body).digest())
+        if cacheable:
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                return compressed
+
+        if encoding == "br":
+            compressed = brotli.compress(body, quality=self.brotli_quality, mode=brotli.MODE_TEXT)
+        else:
+            compressed = _gzip(body, self.gzip_level)
+        if cacheable:
+            self.cache.set(key, compressed)
+        return compressed
+
+    def _compressor(self, encoding: str):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=self.brotli_quality, mode=brotli.MODE_TEXT)
+
+            def flush(final=False):
+                return compressor.finish() if final else compressor.flush()
+
+            return compressor.process, flush
+
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+
+        def flush(final=False):
+            return compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+        return compressor.compress, flush
+
+
+def _gzip(body: bytes, level: int) -> bytes:
+    # wbits=31 writes a gzip header, without the mtime gzip.compress adds
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def _no_write(data):
+    raise RuntimeError("The compression middleware doesn't support the write() callable")
+
+
+def init_app(app):
+    cfg = app.config
+    if not cfg["COMPRESS_ENABLED"]:
+        return
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=cfg["COMPRESS_MIN_SIZE"],
+        gzip_level=cfg["COMPRESS_GZIP_LEVEL"],
+        brotli_quality=cfg["COMPRESS_BROTLI_QUALITY"],
+        mimetypes=cfg["COMPRESS_MIMETYPES"],
+        cache_max_bytes=cfg["COMPRESS_CACHE_MAX_BYTES"],
+    )
@@ -0,0 +1,246 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from werkzeug.exceptions import HTTPException
+
+from hackspace_website import prefetch
+from hackspace_website.page_cache import compress_html, write_atomic
+
+logger = logging.getLogger(__name__)
+
+# Kept in the output directory, the web server never serves it since only
+# <path>.html is looked up
+MANIFEST = ".export-manifest.json"
+LOCK = ".export.lock"
+
+# Settings the pages depend on besides the templates and CMS content
+CONFIG_KEYS = (
+    "SITE_URL",
+    "PUBLIC_MEDIA_URL",
+    "HTML_REWRITER_BACKEND",
+    "MEDIA_VARIANTS_ENABLED",
+    "MEDIA_VARIANT_WIDTHS",
+    "MEDIA_VARIANT_SIZES",
+    "BLOG_PAGE_SIZE",
+)
+
+# Slugs that are safe as a file name, posts with anything else are left to
+# the app
+SLUG_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class SiteExporter:
+    """Writes the pages that are the same for every visitor into `output`
+    as plain HTML (with .gz/.br siblings), for the web server in front to
+    serve without asking the app. Forms and media still go to the app.
+
+    Each page is keyed by a hash of what it's rendered from: the templates,
+    the asset manifest, a few settings and its own CMS content. Pages whose
+    key matches the last export aren't rendered again, and pages that no
+    longer exist (unpublished posts, blog pages past the end) are removed.
+    If the CMS can't be reached for a page its last export is kept.
+    """
+
+    def __init__(self, app, output: str, workers: int):
+        self.app = app
+        self.output = output
+        self.workers = workers
+
+    def site_version(self) -> str:
+        digest = hashlib.sha256()
+        template_root = os.path.join(self.app.root_path, self.app.template_folder)
+        for root, dirs, files in os.walk(template_root):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, template_root).encode() + b"\0")
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+        # Pages link to the hashed static files of the current build
+        assets = self.app.extensions.get("assets")
+        if assets is not None and os.path.exists(assets.manifest_path):
+            with open(assets.manifest_path, "rb") as f:
+                digest.update(f.read())
+        settings = [self.app.config.get(key) for key in CONFIG_KEYS]
+        digest.update(json.dumps(settings, default=str).encode())
+        return digest.hexdigest()
+
+    def pages(self) -> tuple[dict, set]:
+        """Fetch the CMS content of every page. Returns path -> (file, content,
+        post URL) and the paths whose content couldn't be fetched."""
+        cfg = self.app.config
+        cache = self.app.extensions["cms_cache"]
+        pages = {"/": ("index.html", None, None), "/visit": ("visit.html", None, None)}
+        failed = set()
+
+        open_day_url = cfg["CMS_OPEN_DAY_URL"]
+        try:
+            open_day = cache.fetch(open_day_url)
+            cache.store(open_day_url, open_day)
+            pages["/open-day"] = ("open-day.html", open_day, None)
+        except Exception:
+            logger.warning("Fetching the open day page failed", exc_info=True)
+            failed.add("/open-day")
+
+        # Without the list nothing can be told apart from unpublished, so
+        # let this one fail the export
+        posts = prefetch.fetch_blog_list(cache)
+        cache.store(cfg["CMS_BLOG_LIST_URL"], posts)
+        per_page = cfg["BLOG_PAGE_SIZE"]
+        count = max(1, -(-len(posts) // per_page))
+        for page in range(1, count + 1):
+            content = {"posts": posts[(page - 1) * per_page:page * per_page], "pages": count}
+            pages[f"/blog?page={page}"] = (f"blog-page-{page}.html", content, None)
+
+        urls = {}
+        for post in posts:
+            slug = post.get("slug")
+            if not slug:
+                continue
+            if not SLUG_RE.match(slug):
+                logger.warning("Not exporting post %r, its slug isn't safe as a file name", slug)
+                continue
+            urls[slug] = cfg["CMS_BLOG_DETAIL_URL"].format(slug=slug)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cms-export") as pool:
+            futures = {pool.submit(cache.fetch, url): slug for slug, url in urls.items()}
+            for future in as_completed(futures):
+                slug = futures[future]
+                try:
+                    post = future.result()
+                except Exception:
+                    logger.warning("Fetching %s failed", urls[slug], exc_info=True)
+                    failed.add(f"/blog/{slug}")
+                    continue
+                cache.store(urls[slug], post)
+                pages[f"/blog/{slug}"] = (f"blog/{slug}.html", post, urls[slug])
+        return pages, failed
+
+    def render(self, path: str) -> bytes | None:
+        with self.app.app_context(), self.app.test_request_context(path, base_url=self.app.config["SITE_URL"]):
+            # Straight to the view, before_request would start this
+            # process's background threads and count against rate limits
+            try:
+                response = self.app.make_response(self.app.dispatch_request())
+            except HTTPException as e:
+                logger.warning("Not exporting %s: %s", path, e)
+                return None
+        if response.status_code != 200:
+            logger.warning("Not exporting %s: %s", path, response.status)
+            return None
+        return response.get_data()
+
+    def _write(self, name: str, body: bytes):
+        path = os.path.join(self.output, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, body)
+        encoded = compress_html(body)
+        for encoding, ext in (("gzip", ".gz"), ("br", ".br")):
+            data = encoded.get(encoding)
+            if data is not None and len(data) < len(body):
+                write_atomic(path + ext, data)
+            elif os.path.exists(path + ext):
+                os.unlink(path + ext)
+
+    def _remove(self, name: str):
+        path = os.path.join(self.output, *name.split("/"))
+        for ext in ("", ".gz", ".br"):
+            try:
+                os.unlink(path + ext)
+            except FileNotFoundError:
+                pass
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.output, MANIFEST)) as f:
+                return json.load(f)["pages"]
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError):
+            logger.warning("Ignoring corrupt export manifest, exporting everything")
+            return {}
+
+    def export(self, force: bool = False) -> dict:
+        os.makedirs(self.output, exist_ok=True)
+        # One export at a time, e.g. from cron and a deploy
+        with open(os.path.join(self.output, LOCK), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._export(force)
+
+    def _export(self, force: bool) -> dict:
+        previous = self._load_manifest()
+        version = self.site_version()
+        pages, failed = self.pages()
+        has_prefetcher = "cms_prefetcher" in self.app.extensions
+        cache = self.app.extensions["cms_cache"]
+
+        entries = {}
+        stats = {"rendered": 0, "unchanged": 0, "removed": 0, "failed": len(failed)}
+        for path, (name, content, post_url) in pages.items():
+            key = hashlib.sha256(json.dumps([version, content], sort_keys=True, default=str).encode()).hexdigest()
+            entry = previous.get(path)
+            unchanged = entry is not None and entry["key"] == key
+            if unchanged and not force and os.path.exists(os.path.join(self.output, entry["file"])):
+                entries[path] = entry
+                stats["unchanged"] += 1
+                continue
+
+            if post_url is not None and has_prefetcher:
+                # blog_detail reads the rewritten body the prefetcher
+                # stores, which may be older than what was just fetched
+                prefetch.store_post(cache, post_url, content)
+            body = self.render(path)
+            if body is None:
+                stats["failed"] += 1
+                if entry is not None:
+                    entries[path] = entry
+                continue
+            self._write(name, body)
+            entries[path] = {"file": name, "key": key}
+            stats["rendered"] += 1
+
+        for path in failed:
+            if path in previous:
+                entries[path] = previous[path]
+        for path, entry in previous.items():
+            if path not in entries:
+                self._remove(entry["file"])
+                stats["removed"] += 1
+
+        manifest = {"pages": entries}
+        write_atomic(os.path.join(self.output, MANIFEST), json.dumps(manifest, indent=1).encode())
+        return stats
+
+
+export_cli = AppGroup("export", help="Static HTML export of the site.")
+
+
+@export_cli.command("build")
+@click.option("--force", is_flag=True, help="Render every page, even unchanged ones.")
+def build_command(force):
+    """Render the pages that don't need the app into EXPORT_DIR."""
+    exporter = current_app.extensions["site_export"]
+    try:
+        stats = exporter.export(force=force)
+    except Exception as e:
+        raise click.ClickException(f"Export failed: {e}")
+    click.echo(
+        f"Exported into {exporter.output}: {stats['rendered']} rendered, {stats['unchanged']} unchanged, "
+        f"{stats['removed']} removed, {stats['failed']} failed"
+    )
+
+
+def init_app(app):
+    app.cli.add_command(export_cli)
+    app.extensions["site_export"] = SiteExporter(
+        app,
+        app.config.get("EXPORT_DIR") or os.path.join(app.instance_path, "export"),
+        workers=app.config["CMS_PREFETCH_WORKERS"],
+    )
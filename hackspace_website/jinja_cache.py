@@ -0,0 +1,34 @@
+import os
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache
+
+# Compiling the templates is most of what a fresh worker does on its first
+# requests. Jinja writes the compiled code next to nothing else in
+# `directory` (atomically, so workers can share it) and reuses it for as
+# long as the template source doesn't change.
+
+templates_cli = AppGroup("templates", help="Compiled template cache.")
+
+
+@templates_cli.command("compile")
+def compile_command():
+    """Compile every template into the bytecode cache."""
+    env = current_app.jinja_env
+    if env.bytecode_cache is None:
+        raise click.ClickException("JINJA_BYTECODE_CACHE is off")
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    click.echo(f"Compiled {len(names)} template(s) into {env.bytecode_cache.directory}")
+
+
+def init_app(app):
+    app.cli.add_command(templates_cli)
+    if not app.config["JINJA_BYTECODE_CACHE"]:
+        return
+    directory = app.config.get("JINJA_BYTECODE_CACHE_DIR") or os.path.join(app.instance_path, "jinja-cache")
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
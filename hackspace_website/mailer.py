@@ -1,19 +1,377 @@
-from email.mime.text import MIMEText
 from flask import current_app
-import smtplib
-import ssl
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import click
+from flask.cli import AppGroup
+
+from hackspace_website import metrics
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_MODES = ("thread", "external", "sync")
+
+
+# smtplib, ssl and the email package are imported where they're used, most
+# workers start and never send anything themselves
+
+
+def _build_message(sender: str, receiver: str, reply_to: str | None, subject: str, text: str):
+    from email.mime.text import MIMEText
+
+    message = MIMEText(text, "plain")
+    message["Subject"] = subject
+    message["From"] = sender
+    message["To"] = receiver
+    if reply_to:
+        message['reply-to'] = reply_to
+    return message
+
+
+def _send_now(reply_to: str | None, subject: str, text: str):
+    import smtplib
+    import ssl
 
-def send_internal(reply_to: str | None, subject: str, text: str):
     context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(current_app.config["SMTP_SERVER"], current_app.config["SMTP_PORT"], context=context) as smtp_client:
+    with metrics.span("smtp"), smtplib.SMTP_SSL(current_app.config["SMTP_SERVER"], current_app.config["SMTP_PORT"], context=context) as smtp_client:
         smtp_client.login(current_app.config["SMTP_EMAIL"], current_app.config["SMTP_PASSWORD"])
         sender_email = current_app.config["SMTP_EMAIL"]
         receiver_email = current_app.config["SMTP_EMAIL"]
 
-        message = MIMEText(text, "plain")
-        message["Subject"] = subject
-        message["From"] = sender_email
-        message["To"] = receiver_email
-        if reply_to:
-            message['reply-to'] = reply_to
-        smtp_client.sendmail(sender_email, receiver_email, message.as_string())
\ No newline at end of file
+        message = _build_message(sender_email, receiver_email, reply_to, subject, text)
+        smtp_client.sendmail(sender_email, receiver_email, message.as_string())
+
+
+class MailSpool:
+    """Durable queue of outgoing mail in a SQLite file shared by every worker.
+
+    A message is claimed for `claim_timeout` seconds before sending, so two
+    senders never pick up the same row and a sender that dies mid-batch only
+    delays its messages. Delivered messages are deleted; ones that keep
+    failing are kept with status 'failed' and their last error.
+    """
+
+    def __init__(self, path: str, claim_timeout: float):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # The file is created on first use rather than in create_app, so CLI
+        # commands and scripts that never send mail don't write it
+        self._ready = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Submissions only exist here until sent, so don't lose them on a crash
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS mail_spool ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "reply_to TEXT, subject TEXT NOT NULL, body TEXT NOT NULL, "
+                        "status TEXT NOT NULL DEFAULT 'pending', "
+                        "attempts INTEGER NOT NULL DEFAULT 0, "
+                        "next_attempt_at REAL NOT NULL, claimed_until REAL, "
+                        "last_error TEXT, created_at REAL NOT NULL)"
+                    )
+                    conn.execute(
+                        "CREATE INDEX IF NOT EXISTS ix_mail_spool_next_attempt_at "
+                        "ON mail_spool (status, next_attempt_at)"
+                    )
+                    self._ready = True
+        return conn
+
+    def enqueue(self, reply_to: str | None, subject: str, text: str) -> int:
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO mail_spool (reply_to, subject, body, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (reply_to, subject, text, now, now),
+        )
+        return cursor.lastrowid
+
+    def claim(self, limit: int) -> list:
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, reply_to, subject, body, attempts FROM mail_spool "
+                "WHERE status = 'pending' AND next_attempt_at <= ? "
+                "AND (claimed_until IS NULL OR claimed_until < ?) "
+                "ORDER BY id LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE mail_spool SET claimed_until = ? WHERE id = ?",
+                [(now + self.claim_timeout, row[0]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def delivered(self, message_id: int):
+        self._connect().execute("DELETE FROM mail_spool WHERE id = ?", (message_id,))
+
+    def retry(self, message_id: int, attempts: int, error: str, next_attempt_at: float | None):
+        # next_attempt_at None means we've given up on it
+        if next_attempt_at is None:
+            self._connect().execute(
+                "UPDATE mail_spool SET status = 'failed', attempts = ?, last_error = ?, "
+                "claimed_until = NULL WHERE id = ?",
+                (attempts, error, message_id),
+            )
+        else:
+            self._connect().execute(
+                "UPDATE mail_spool SET attempts = ?, last_error = ?, next_attempt_at = ?, "
+                "claimed_until = NULL WHERE id = ?",
+                (attempts, error, next_attempt_at, message_id),
+            )
+
+    def counts(self) -> dict:
+        rows = self._connect().execute(
+            "SELECT status, COUNT(*) FROM mail_spool GROUP BY status"
+        ).fetchall()
+        return dict(rows)
+
+    def requeue_failed(self) -> int:
+        cursor = self._connect().execute(
+            "UPDATE mail_spool SET status = 'pending', attempts = 0, next_attempt_at = ? "
+            "WHERE status = 'failed'",
+            (time.time(),),
+        )
+        return cursor.rowcount
+
+
+class MailSender:
+    """Delivers spooled mail over one authenticated SMTP connection, which is
+    kept open between batches and closed once it has been idle for a while."""
+
+    def __init__(self, spool: MailSpool, config):
+        self.spool = spool
+        self.config = config
+        self._smtp = None
+        self._last_used = 0.0
+        self.wakeup = threading.Event()
+
+    def _connection(self):
+        import smtplib
+        import ssl
+
+        cfg = self.config
+        if self._smtp is not None and time.monotonic() - self._last_used > cfg["MAIL_SMTP_IDLE_TIMEOUT"]:
+            # The server has most likely hung up on us by now
+            self.close()
+        if self._smtp is None:
+            context = ssl.create_default_context()
+            smtp = smtplib.SMTP_SSL(
+                cfg["SMTP_SERVER"], cfg["SMTP_PORT"], context=context, timeout=cfg["MAIL_SMTP_TIMEOUT"]
+            )
+            try:
+                smtp.login(cfg["SMTP_EMAIL"], cfg["SMTP_PASSWORD"])
+            except BaseException:
+                smtp.close()
+                raise
+            self._smtp = smtp
+        return self._smtp
+
+    def close(self):
+        if self._smtp is None:
+            return
+        import smtplib
+
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+    def _send(self, reply_to, subject, text):
+        import smtplib
+
+        sender_email = self.config["SMTP_EMAIL"]
+        receiver_email = self.config["SMTP_EMAIL"]
+        message = _build_message(sender_email, receiver_email, reply_to, subject, text).as_string()
+
+        reconnected = False
+        while True:
+            smtp = self._connection()
+            try:
+                with metrics.span("smtp"):
+                    smtp.sendmail(sender_email, receiver_email, message)
+                break
+            except smtplib.SMTPServerDisconnected:
+                # A kept-alive connection can be dropped at any point, try a
+                # fresh one before counting it as a failed attempt. Close
+                # the dead one first so its socket isn't left open.
+                try:
+                    self.close()
+                except Exception:
+                    pass
+                self._smtp = None
+                if reconnected:
+                    raise
+                reconnected = True
+        self._last_used = time.monotonic()
+
+    def _backoff(self, attempts: int) -> float:
+        cfg = self.config
+        return min(cfg["MAIL_RETRY_BACKOFF"] * 2 ** (attempts - 1), cfg["MAIL_RETRY_BACKOFF_MAX"])
+
+    def send_batch(self) -> int:
+        """Send whatever is due, returns the number of messages delivered."""
+        rows = self.spool.claim(self.config["MAIL_BATCH_SIZE"])
+        if not rows:
+            return 0
+        import smtplib
+
+        sent = 0
+        for message_id, reply_to, subject, text, attempts in rows:
+            try:
+                self._send(reply_to, subject, text)
+            except Exception as e:
+                # Anything else is most likely the message itself (e.g. a
+                # header that won't encode), count it as an attempt too so it
+                # can't hold up the rest of the batch or retry forever
+                if isinstance(e, (smtplib.SMTPException, OSError)):
+                    self.close()
+                attempts += 1
+                if attempts >= self.config["MAIL_MAX_ATTEMPTS"]:
+                    logger.error("Giving up on mail %d after %d attempts: %s", message_id, attempts, e)
+                    self.spool.retry(message_id, attempts, repr(e), None)
+                else:
+                    delay = self._backoff(attempts)
+                    logger.warning("Sending mail %d failed, retrying in %gs: %s", message_id, delay, e)
+                    self.spool.retry(message_id, attempts, repr(e), time.time() + delay)
+                continue
+            self.spool.delivered(message_id)
+            sent += 1
+        return sent
+
+    def run(self, stop: threading.Event | None = None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                sent = self.send_batch()
+            except Exception:
+                logger.exception("Mail delivery loop failed")
+                sent = 0
+            if sent < self.config["MAIL_BATCH_SIZE"]:
+                # Nothing left that's due; sleep until the next poll unless
+                # this process queues something in the meantime
+                self.wakeup.wait(self.config["MAIL_POLL_INTERVAL"])
+                self.wakeup.clear()
+        self.close()
+
+
+class MailQueue:
+
+    def __init__(self, app):
+        cfg = app.config
+        path = cfg.get("MAIL_SPOOL_PATH") or os.path.join(app.instance_path, "mail_spool.sqlite3")
+        self.spool = MailSpool(path, cfg["MAIL_CLAIM_TIMEOUT"])
+        self.sender = MailSender(self.spool, cfg)
+        self.start_thread = cfg["MAIL_DELIVERY"] == "thread"
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_worker(self):
+        # Threads don't survive gunicorn's fork, so check we started this
+        # one in the current process
+        if not self.start_thread or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.sender = MailSender(self.spool, self.sender.config)
+            self._thread = threading.Thread(target=self.sender.run, name="mail-sender", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, reply_to: str | None, subject: str, text: str):
+        self.spool.enqueue(reply_to, subject, text)
+        self.ensure_worker()
+        self.sender.wakeup.set()
+
+
+def send_internal(reply_to: str | None, subject: str, text: str):
+    queue = current_app.extensions.get("mail_queue")
+    with metrics.span("mail"):
+        if queue is None:
+            _send_now(reply_to, subject, text)
+        else:
+            queue.submit(reply_to, subject, text)
+
+
+mail_cli = AppGroup("mail", help="Outgoing mail queue.")
+
+
+def _queue() -> MailQueue:
+    queue = current_app.extensions.get("mail_queue")
+    if queue is None:
+        raise click.ClickException("MAIL_DELIVERY is 'sync', there is no queue")
+    return queue
+
+
+@mail_cli.command("worker")
+def worker_command():
+    """Deliver queued mail until interrupted."""
+    queue = _queue()
+    click.echo(f"Delivering mail from {queue.spool.path}")
+    try:
+        queue.sender.run()
+    except KeyboardInterrupt:
+        queue.sender.close()
+
+
+@mail_cli.command("flush")
+def flush_command():
+    """Send everything that is currently due and exit."""
+    queue = _queue()
+    total = 0
+    while True:
+        sent = queue.sender.send_batch()
+        total += sent
+        if sent < current_app.config["MAIL_BATCH_SIZE"]:
+            break
+    queue.sender.close()
+    click.echo(f"Sent {total} message(s), queue: {queue.spool.counts()}")
+
+
+@mail_cli.command("status")
+def status_command():
+    """Show how many messages are pending or failed."""
+    click.echo(_queue().spool.counts())
+
+
+@mail_cli.command("retry-failed")
+def retry_failed_command():
+    """Put messages that ran out of attempts back in the queue."""
+    click.echo(f"Requeued {_queue().spool.requeue_failed()} message(s)")
+
+
+def init_app(app):
+    if app.config["MAIL_DELIVERY"] not in DELIVERY_MODES:
+        raise ValueError(f"MAIL_DELIVERY must be one of {', '.join(DELIVERY_MODES)}")
+    app.cli.add_command(mail_cli)
+    if app.config["MAIL_DELIVERY"] == "sync":
+        return
+
+    queue = MailQueue(app)
+    app.extensions["mail_queue"] = queue
+    # Start the sender with the first request, so it's running in each
+    # worker after the fork and not in `flask` CLI commands
+    app.before_request(queue.ensure_worker)
@@ -0,0 +1,195 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CachedMedia:
+
+    def __init__(self, path: str, meta: dict):
+        self.path = path
+        self.meta = meta
+
+
+class MediaCache:
+    """Size-capped directory of media objects shared by every worker.
+
+    Each object is stored as `<sha256>.bin` with its headers alongside in
+    `<sha256>.json`. Files are written to a temp file and renamed into place,
+    so a reader never sees a half-written object, and the least recently used
+    objects (by file mtime) are removed once the directory grows past
+    `max_bytes`. Eviction takes an flock so only one worker scans at a time.
+    """
+
+    TOUCH_INTERVAL = 60
+    # Each worker only sees its own writes, so rescan now and then to notice
+    # the others'
+    RESCAN_INTERVAL = 300
+    LOCK_STRIPES = 256
+
+    def __init__(self, directory: str, max_bytes: int, max_object_bytes: int, revalidate_after: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.revalidate_after = revalidate_after
+        os.makedirs(directory, exist_ok=True)
+        self._lock_path = os.path.join(directory, ".lock")
+        os.makedirs(os.path.join(directory, "locks"), exist_ok=True)
+        self._size_lock = threading.Lock()
+        self._approx_size = self._scan_size()
+        self._last_scan = time.time()
+
+    def _paths(self, key: str):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        subdir = os.path.join(self.directory, digest[:2])
+        return os.path.join(subdir, digest + ".bin"), os.path.join(subdir, digest + ".json")
+
+    @contextmanager
+    def fill_lock(self, key: str, timeout: float):
+        """Cross-worker lock held while fetching `key` from the bucket, so
+        only one worker downloads it. Keys share a fixed set of lock files
+        which never need cleaning up. Yields False if the lock couldn't be
+        taken in time, in which case the caller just goes ahead."""
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        stripe = int(digest[:8], 16) % self.LOCK_STRIPES
+        path = os.path.join(self.directory, "locks", f"{stripe:03d}.lock")
+
+        with open(path, "w") as lock:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        yield False
+                        return
+                    time.sleep(0.02)
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, key: str) -> CachedMedia | None:
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            stat = os.stat(data_path)
+        except (FileNotFoundError, ValueError):
+            return None
+        if stat.st_size != meta["size"]:
+            # Another worker is halfway through replacing this object
+            return None
+
+        if time.time() - stat.st_mtime > self.TOUCH_INTERVAL:
+            try:
+                os.utime(data_path)
+            except FileNotFoundError:
+                return None
+        return CachedMedia(data_path, meta)
+
+    def is_stale(self, entry: CachedMedia) -> bool:
+        return time.time() - entry.meta["stored_at"] > self.revalidate_after
+
+    def mark_fresh(self, key: str, entry: CachedMedia):
+        entry.meta["stored_at"] = time.time()
+        _, meta_path = self._paths(key)
+        self._write_atomic(meta_path, json.dumps(entry.meta).encode())
+
+    def put(self, key: str, chunks, meta: dict) -> CachedMedia:
+        data_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(data_path), suffix=".tmp")
+        size = 0
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, data_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        meta = dict(meta, size=size, sha256=digest.hexdigest(), stored_at=time.time())
+        self._write_atomic(meta_path, json.dumps(meta).encode())
+
+        with self._size_lock:
+            self._approx_size += size
+            over = self._approx_size > self.max_bytes
+        if over or time.time() - self._last_scan > self.RESCAN_INTERVAL:
+            self.evict()
+        return CachedMedia(data_path, meta)
+
+    def delete(self, key: str):
+        for path in self._paths(key):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        with open(self._lock_path, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # someone else is already evicting
+
+            entries = []
+            total = 0
+            for data_path, stat in self._iter_objects():
+                entries.append((stat.st_mtime, stat.st_size, data_path))
+                total += stat.st_size
+
+            # Trim to 90% so we aren't evicting again on the very next write
+            target = self.max_bytes * 0.9
+            entries.sort()
+            for _, size, data_path in entries:
+                if total <= target:
+                    break
+                for path in (data_path, data_path[:-len(".bin")] + ".json"):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+
+            with self._size_lock:
+                self._approx_size = total
+                self._last_scan = time.time()
+            logger.debug("Media cache is %d bytes after eviction", total)
+
+    def _iter_objects(self):
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir() or subdir.name == "locks":
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(".bin"):
+                    try:
+                        yield entry.path, entry.stat()
+                    except FileNotFoundError:
+                        pass
+
+    def _scan_size(self) -> int:
+        return sum(stat.st_size for _, stat in self._iter_objects())
+
+    def _write_atomic(self, path: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -0,0 +1,78 @@
+from functools import lru_cache
+import importlib.util
+import io
+
+# Pillow is optional, originals are served without it. It's only imported
+# once something is resized since it's slow to load.
+
+# format name -> (mimetype, Pillow encoder, save options)
+FORMATS = {
+    "avif": ("image/avif", "AVIF", {"speed": 8}),
+    "webp": ("image/webp", "WEBP", {"method": 4}),
+    "jpeg": ("image/jpeg", "JPEG", {"optimize": True, "progressive": True}),
+    "png": ("image/png", "PNG", {"optimize": True}),
+}
+
+# Source types we know how to resize. GIFs are left alone since resizing
+# would drop the animation, and SVGs don't need it.
+SOURCE_FORMATS = {
+    "image/jpeg": "jpeg",
+    "image/png": "png",
+    "image/webp": "webp",
+}
+
+
+@lru_cache(maxsize=None)
+def available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+def enabled(config) -> bool:
+    # Variants are rendered from the disk cache, so they need it switched on
+    return bool(config["MEDIA_VARIANTS_ENABLED"] and config["MEDIA_CACHE_ENABLED"] and available())
+
+
+def can_encode(fmt: str) -> bool:
+    if not available() or fmt not in FORMATS:
+        return False
+    if fmt in ("avif", "webp"):
+        from PIL import features
+        return features.check(fmt)
+    return True
+
+
+def image_width(path: str) -> int:
+    from PIL import Image
+
+    with Image.open(path) as im:
+        return im.width
+
+
+def render(path: str, width: int, fmt: str, quality: int, max_pixels: int) -> bytes:
+    """Scale the image at `path` down to `width` pixels wide (never up) and
+    encode it as `fmt`."""
+    from PIL import Image, ImageOps
+
+    mimetype, encoder, options = FORMATS[fmt]
+    with Image.open(path) as im:
+        if im.width * im.height > max_pixels:
+            raise ValueError(f"{im.width}x{im.height} image is too large to resize")
+        # Let JPEGs decode at a reduced scale, a big saving for camera photos.
+        # Ask for width x width so it's still wide enough after EXIF rotation.
+        im.draft("RGB", (width, width))
+        im = ImageOps.exif_transpose(im)
+        if im.width > width:
+            height = max(1, round(im.height * width / im.width))
+            im = im.resize((width, height), Image.Resampling.LANCZOS)
+
+        if fmt == "jpeg" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        elif im.mode not in ("RGB", "RGBA", "L", "LA"):
+            im = im.convert("RGBA")
+
+        out = io.BytesIO()
+        if fmt == "png":
+            im.save(out, encoder, **options)
+        else:
+            im.save(out, encoder, quality=quality, **options)
+        return out.getvalue()
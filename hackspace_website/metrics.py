@@ -0,0 +1,207 @@
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+import ipaddress
+import hmac
+import os
+import threading
+import time
+
+from flask import (
+    Blueprint, Response, abort, before_render_template, current_app, g, has_request_context,
+    request, template_rendered,
+)
+
+# Upper bounds (seconds) of the latency histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+bp = Blueprint('metrics', __name__)
+
+# Set by init_app when METRICS_ENABLED. A module global rather than an app
+# extension so spans in background threads (mail, prefetch) can record
+# without an app context, and so a disabled span costs one lookup.
+registry = None
+
+_NOOP = nullcontext()
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    """Latency histograms and counters for this worker process."""
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, labels: tuple, value: float):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: (list(h.counts), h.sum) for key, h in self.histograms.items()}
+
+
+@contextmanager
+def _timed(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe("hackspace_span_seconds", (("span", name),), elapsed)
+        if has_request_context():
+            timings = g.setdefault("server_timing", {})
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def span(name: str):
+    """Time a block as `name` in /metrics and the Server-Timing header."""
+    if registry is None:
+        return _NOOP
+    return _timed(name)
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+
+
+def _finish_request(response):
+    started = g.pop("request_started", None)
+    if started is None or registry is None:
+        return response
+    elapsed = time.perf_counter() - started
+    registry.observe("hackspace_request_seconds", (
+        ("endpoint", request.endpoint or "none"),
+        ("method", request.method),
+        ("status", str(response.status_code)),
+    ), elapsed)
+    if current_app.config["METRICS_SERVER_TIMING"]:
+        timings = g.get("server_timing", {})
+        response.headers["Server-Timing"] = ", ".join(
+            [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+            + [f"total;dur={elapsed * 1000:.1f}"]
+        )
+    return response
+
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault("template_started", []).append(time.perf_counter())
+
+
+def _template_finished(sender, template, context, **extra):
+    started = g.get("template_started")
+    if not started or registry is None:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    registry.observe("hackspace_span_seconds", (("span", "template"),), elapsed)
+    timings = g.setdefault("server_timing", {})
+    timings["template"] = timings.get("template", 0.0) + elapsed
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _metric_name(name: str) -> str:
+    return "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+
+
+def _render(snapshot: dict, gauges: dict) -> str:
+    lines = []
+    by_name = {}
+    for (name, labels), value in sorted(snapshot.items()):
+        by_name.setdefault(name, []).append((labels, value))
+    for name, series in by_name.items():
+        lines.append(f"# TYPE {name} histogram")
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels((*labels, ('le', bound)))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    for name, value in sorted(gauges.items()):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _stat_gauges(prefix: str, stats: dict) -> dict:
+    return {
+        _metric_name(f"{prefix}_{key}"): value
+        for key, value in stats.items() if isinstance(value, (int, float))
+    }
+
+
+def _gauges() -> dict:
+    # Counters the other modules already keep
+    from hackspace_website import mosparo
+    from hackspace_website.views import media
+
+    gauges = {"hackspace_worker_pid": os.getpid()}
+    gauges.update(_stat_gauges("hackspace_media", media.stats()))
+    mosparo_stats = mosparo.stats()
+    gauges.update(_stat_gauges("hackspace_mosparo", mosparo_stats))
+    if "circuit_state" in mosparo_stats:
+        gauges["hackspace_mosparo_circuit_open"] = int(mosparo_stats["circuit_state"] != "closed")
+    mail_queue = current_app.extensions.get("mail_queue")
+    if mail_queue is not None:
+        counts = mail_queue.spool.counts()
+        for status in ("pending", "failed"):
+            gauges[f"hackspace_mail_{status}"] = counts.get(status, 0)
+    return gauges
+
+
+def _allowed() -> bool:
+    token = current_app.config.get("METRICS_TOKEN")
+    if token:
+        supplied = request.headers.get("Authorization", "")
+        return hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode())
+    # Without a token only local scrapes are allowed
+    try:
+        return ipaddress.ip_address(request.remote_addr or "").is_loopback
+    except ValueError:
+        return False
+
+
+@bp.route("/metrics")
+def metrics():
+    if registry is None:
+        abort(404)
+    if not _allowed():
+        abort(403)
+    return Response(_render(registry.snapshot(), _gauges()), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    global registry
+    app.register_blueprint(bp)
+    # One app per process, the last one configured decides
+    registry = Registry() if app.config["METRICS_ENABLED"] else None
+    if registry is None:
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
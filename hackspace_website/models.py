@@ -0,0 +1,30 @@
+from flask_migrate import Migrate
+from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy as sa
+
+db = SQLAlchemy()
+migrate = Migrate()
+
+
+class BannedIp(db.Model):
+    __tablename__ = "banned_ip"
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    ip_addr = sa.Column(sa.String(120), nullable=False, unique=True, index=True)
+    expiry = sa.Column(sa.DateTime, nullable=True)
+
+
+class Message(db.Model):
+    __tablename__ = "message"
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    name = sa.Column(sa.String(120), nullable=False)
+    email = sa.Column(sa.String(200), nullable=False)
+    subject = sa.Column(sa.String(200), nullable=False)
+    message = sa.Column(sa.Text, nullable=False)
+    ip_addr = sa.Column(sa.String(120), nullable=False)
+    user_agent = sa.Column(sa.String(120), nullable=False)
+    honeypot_triggered = sa.Column(sa.Boolean, nullable=False)
+    received = sa.Column(sa.DateTime, nullable=False)
+    processed = sa.Column(sa.Boolean, nullable=False, server_default=sa.false(), index=True)
+    rejected = sa.Column(sa.Boolean, nullable=False, server_default=sa.false())
@@ -1,19 +1,157 @@
-from flask import Flask, current_app, g, request
+from collections import Counter
+import logging
+import threading
+import time
+
+from flask import Flask, abort, current_app, request
 from flask_wtf import FlaskForm
 from werkzeug.local import LocalProxy
-from mosparo_api_client import Client as MosparoClient
+
+from hackspace_website import metrics
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the verification latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
 
 
 def mosparo_enabled() -> bool:
     return current_app.config.get("MOSPARO_ENABLED", True)
 
+
+class CircuitBreaker:
+    """Stops calling a failing service for a while.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    `allow()` returns False for `reset_timeout` seconds. Then a single trial
+    call is let through: success closes the circuit again, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning("Mosparo circuit opened after %d failure(s)", self.failures)
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class MosparoVerifier:
+    # One per process, shared by every request.
+
+    def __init__(self, make_client, breaker: CircuitBreaker, fail_open: bool):
+        self._make_client = make_client
+        self._client = None
+        self.breaker = breaker
+        self.fail_open = fail_open
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Made on first use, the Mosparo client pulls in requests, which
+        # workers that never see a form don't need to import
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._make_client()
+        return self._client
+
+    def _count(self, **counts):
+        with self._lock:
+            self._stats.update(counts)
+
+    def _observe(self, elapsed: float):
+        bucket = next((b for b in LATENCY_BUCKETS if elapsed <= b), "inf")
+        with self._lock:
+            self._stats["latency_seconds_sum"] += elapsed
+            self._stats[f"latency_le_{bucket}"] += 1
+            self._stats["latency_seconds_max"] = max(self._stats["latency_seconds_max"], elapsed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["circuit_state"] = self.breaker.state
+        return snapshot
+
+    def _unavailable(self) -> bool:
+        if self.fail_open:
+            self._count(failed_open=1)
+            logger.warning("Mosparo unavailable, accepting submission unverified")
+            return True
+        self._count(failed_closed=1)
+        abort(503, description="Spam protection is temporarily unavailable, please try again later.")
+
+    def verify(self, formdata) -> bool:
+        submit_token = formdata.get("_mosparo_submitToken")
+        validation_token = formdata.get("_mosparo_validationToken")
+        if not submit_token or not validation_token:
+            # The widget never ran, e.g. a bot posting directly
+            self._count(rejected=1)
+            return False
+
+        if not self.breaker.allow():
+            self._count(short_circuited=1)
+            return self._unavailable()
+
+        client = self.client
+        from mosparo_api_client import MosparoException
+
+        start = time.perf_counter()
+        try:
+            result = client.verify_submission(formdata, submit_token, validation_token)
+        except MosparoException as e:
+            self._observe(time.perf_counter() - start)
+            self._count(calls=1, errors=1)
+            self.breaker.failure()
+            logger.warning("Mosparo verification failed: %s", e.__cause__ or e)
+            return self._unavailable()
+
+        self._observe(time.perf_counter() - start)
+        self._count(calls=1)
+        self.breaker.success()
+        submittable = result.is_submittable()
+        self._count(**{"accepted" if submittable else "rejected": 1})
+        return submittable
+
+
 def get_client():
     if not mosparo_enabled():
         return None   # no client needed
-    
-    if 'mosparo' not in g:
-        g.mosparo = MosparoClient(current_app.config["MOSPARO_HOST"], current_app.config["MOSPARO_PUBLIC_KEY"], current_app.config["MOSPARO_PRIVATE_KEY"])
-    return g.mosparo
+    return current_app.extensions["mosparo"].client
 
 client = LocalProxy(get_client)
 
@@ -22,9 +160,33 @@ def verify_formdata():
     # --- If disabled (only the case in dev), always return True ---
     if not mosparo_enabled():
         return True
-    
+
     formdata = request.form.copy()
-    mosparo_submit_token = formdata['_mosparo_submitToken']
-    mosparo_validation_token = formdata['_mosparo_validationToken']
-    result = client.verify_submission(formdata, mosparo_submit_token, mosparo_validation_token)
-    return result.is_submittable()
\ No newline at end of file
+    with metrics.span("mosparo"):
+        return current_app.extensions["mosparo"].verify(formdata)
+
+
+def stats() -> dict:
+    verifier = current_app.extensions.get("mosparo")
+    return verifier.stats() if verifier is not None else {}
+
+
+def init_app(app):
+    cfg = app.config
+    if not cfg.get("MOSPARO_ENABLED", True):
+        return
+
+    def make_client():
+        from hackspace_website.mosparo_client import PooledMosparoClient
+
+        return PooledMosparoClient(
+            cfg["MOSPARO_HOST"],
+            cfg["MOSPARO_PUBLIC_KEY"],
+            cfg["MOSPARO_PRIVATE_KEY"],
+            pool_size=cfg["MOSPARO_POOL_SIZE"],
+            connect_timeout=cfg["MOSPARO_CONNECT_TIMEOUT"],
+            read_timeout=cfg["MOSPARO_READ_TIMEOUT"],
+        )
+
+    breaker = CircuitBreaker(cfg["MOSPARO_BREAKER_THRESHOLD"], cfg["MOSPARO_BREAKER_RESET"])
+    app.extensions["mosparo"] = MosparoVerifier(make_client, breaker, fail_open=cfg["MOSPARO_FAIL_OPEN"])
@@ -0,0 +1,39 @@
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+from mosparo_api_client import Client as MosparoClient, MosparoException
+
+
+class PooledMosparoClient(MosparoClient):
+    # The upstream client calls requests.post() for every verification, a new
+    # connection and TLS handshake each time, with no timeout at all. Send
+    # through one keep-alive session with fixed timeouts instead.
+
+    def __init__(self, host: str, public_key: str, private_key: str,
+                 pool_size: int, connect_timeout: float, read_timeout: float, verify_ssl=True):
+        super().__init__(host, public_key, private_key, verify_ssl)
+        # Verification tokens can only be used once, so never retry
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = (connect_timeout, read_timeout)
+
+    def _send_request(self, method: str, uri: str, data: dict) -> dict:
+        try:
+            if method == "GET":
+                req = self.session.get(self.host + uri, params=data["data"], auth=data["auth"],
+                                       headers=data["headers"], verify=self.verify_ssl, timeout=self.timeout)
+            else:
+                req = self.session.post(self.host + uri, data=json.dumps(data["data"]), auth=data["auth"],
+                                        headers=data["headers"], verify=self.verify_ssl, timeout=self.timeout)
+        except Exception as exc:
+            raise MosparoException("An error occurred while sending the request to mosparo.") from exc
+
+        if not req.text:
+            raise MosparoException("Response from API invalid.")
+        try:
+            return req.json()
+        except ValueError as exc:
+            raise MosparoException("Response from API invalid.") from exc
@@ -0,0 +1,241 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import click
+from flask import Response, current_app, render_template, request
+from flask.cli import AppGroup
+from flask_wtf.csrf import generate_csrf
+from werkzeug.exceptions import HTTPException
+
+try:
+    import brotli
+except ImportError:  # only gzip variants without it
+    brotli = None
+
+from hackspace_website.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Stands in for the per-session CSRF token in cached markup
+CSRF_PLACEHOLDER = "__page-cache-csrf-token__"
+
+# Pages whose GET output only changes on deploy. `flask pages prerender`
+# renders these ahead of the first request.
+PRERENDER_PATHS = ("/", "/visit", "/dd-signup/", "/dd-signup/tiers")
+
+
+def compress_html(body: bytes) -> dict:
+    encoded = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded["br"] = brotli.compress(body, quality=11, mode=brotli.MODE_TEXT)
+    return encoded
+
+
+class CachedPage:
+
+    def __init__(self, body: bytes, rendered_at: float, csrf: bool, encoded: dict | None = None):
+        self.body = body
+        self.rendered_at = rendered_at
+        self.csrf = csrf
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        # Pages with a CSRF token differ per session, so there's no point
+        # compressing them ahead of time
+        if encoded is None:
+            encoded = {} if csrf else compress_html(body)
+        self.encoded = encoded
+
+
+class PageCache:
+    """Rendered pages kept in memory, keyed by template and path. Absolute
+    links in them are built from SITE_URL rather than the request's Host, so
+    a page is the same whichever host it was asked for on.
+
+    Entries are tied to the newest mtime in the templates folder (and of the
+    asset manifest), so editing a template in development re-renders; in
+    production that's only checked once. Pages with forms are cached with a placeholder where the
+    CSRF token goes, filled in per request.
+    """
+
+    def __init__(self, app, directory: str, max_entries: int):
+        self.app = app
+        self.directory = directory
+        self._pages = LRUCache(maxsize=max_entries)
+        self._version = None
+
+    def version(self) -> float:
+        if self._version is None or self.app.jinja_env.auto_reload:
+            newest = 0.0
+            for root, _, files in os.walk(os.path.join(self.app.root_path, self.app.template_folder)):
+                for name in files:
+                    newest = max(newest, os.stat(os.path.join(root, name)).st_mtime)
+            # Pages link to the hashed static files of the current build
+            assets = self.app.extensions.get("assets")
+            if assets is not None and os.path.exists(assets.manifest_path):
+                newest = max(newest, os.stat(assets.manifest_path).st_mtime)
+            self._version = newest
+        return self._version
+
+    def page(self, template: str, **context) -> CachedPage:
+        key = (template, request.path)
+        version = self.version()
+        entry = self._pages.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        html = render_template(template, **context)
+        form = context.get("form")
+        csrf = form is not None and form.meta.csrf
+        if csrf:
+            html = html.replace(form.csrf_token.current_token, CSRF_PLACEHOLDER)
+        page = CachedPage(html.encode(), time.time(), csrf)
+        self._pages.set(key, (version, page))
+        return page
+
+    def respond(self, page: CachedPage) -> Response:
+        if page.csrf:
+            body = page.body.replace(CSRF_PLACEHOLDER.encode(), generate_csrf().encode())
+            response = Response(body, mimetype="text/html")
+            response.vary.add("Cookie")
+            return response
+
+        encoding = None
+        for candidate in ("br", "gzip"):
+            if candidate in page.encoded and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+
+        response = Response(page.encoded.get(encoding, page.body), mimetype="text/html")
+        response.vary.add("Accept-Encoding")
+        if encoding:
+            response.content_encoding = encoding
+            response.set_etag(f"{page.etag}-{encoding}")
+        else:
+            response.set_etag(page.etag)
+        response.last_modified = page.rendered_at
+        # Make browsers check back, the page changes whenever we deploy
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def save(self):
+        """Write every cached page to `directory` so other workers, and the
+        next start, can load them instead of rendering."""
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = []
+        for (template, path), (version, page) in self._pages.items():
+            name = hashlib.sha256(f"{template}\0{path}".encode()).hexdigest()[:24]
+            files = {"identity": name + ".html"}
+            write_atomic(os.path.join(self.directory, files["identity"]), page.body)
+            for encoding, data in page.encoded.items():
+                files[encoding] = f"{name}.html.{encoding}"
+                write_atomic(os.path.join(self.directory, files[encoding]), data)
+            manifest.append({
+                "template": template,
+                "path": path,
+                "version": version,
+                "rendered_at": page.rendered_at,
+                "csrf": page.csrf,
+                "files": files,
+            })
+        write_atomic(os.path.join(self.directory, "manifest.json"), json.dumps(manifest, indent=1).encode())
+        return len(manifest)
+
+    def load(self) -> int:
+        try:
+            with open(os.path.join(self.directory, "manifest.json")) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except ValueError:
+            logger.warning("Ignoring corrupt prerendered page manifest")
+            return 0
+
+        version = self.version()
+        loaded = 0
+        for entry in manifest:
+            if entry.get("version") != version or "path" not in entry:
+                continue  # templates changed since it was rendered
+            data = {}
+            try:
+                for encoding, name in entry["files"].items():
+                    with open(os.path.join(self.directory, name), "rb") as f:
+                        data[encoding] = f.read()
+            except FileNotFoundError:
+                continue
+            body = data.pop("identity")
+            page = CachedPage(body, entry["rendered_at"], entry["csrf"], encoded=data)
+            self._pages.set((entry["template"], entry["path"]), (version, page))
+            loaded += 1
+        return loaded
+
+
+def write_atomic(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            # mkstemp makes it 0600, the front server has to read it too
+            os.fchmod(f.fileno(), 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def canonical_url() -> str:
+    """The current page's URL on SITE_URL, for links that have to be absolute."""
+    return current_app.config["SITE_URL"].rstrip("/") + request.path
+
+
+def render_page(template: str, **context) -> Response:
+    """render_template for GET pages that are the same for every visitor."""
+    cache = current_app.extensions.get("page_cache")
+    if cache is None:
+        return render_template(template, **context)
+    return cache.respond(cache.page(template, **context))
+
+
+pages_cli = AppGroup("pages", help="Pre-rendered page cache.")
+
+
+@pages_cli.command("prerender")
+def prerender_command():
+    """Render the static pages into the instance folder."""
+    cache = current_app.extensions.get("page_cache")
+    if cache is None:
+        raise click.ClickException("PAGE_CACHE_ENABLED is off")
+
+    app = current_app._get_current_object()
+    for path in PRERENDER_PATHS:
+        with app.test_request_context(path, base_url=app.config["SITE_URL"]):
+            # Straight to the view like `flask export build`, before_request
+            # would start the prefetch and mail threads in this short-lived
+            # process
+            try:
+                response = app.make_response(app.dispatch_request())
+            except HTTPException as e:
+                raise click.ClickException(f"{path} returned {e}")
+        if response.status_code != 200:
+            raise click.ClickException(f"{path} returned {response.status}")
+    count = cache.save()
+    click.echo(f"Pre-rendered {count} page(s) into {cache.directory}")
+
+
+def init_app(app):
+    app.cli.add_command(pages_cli)
+    app.add_template_global(canonical_url)
+    if not app.config["PAGE_CACHE_ENABLED"]:
+        return
+    cache = PageCache(
+        app,
+        app.config.get("PAGE_CACHE_DIR") or os.path.join(app.instance_path, "page-cache"),
+        max_entries=app.config["PAGE_CACHE_MAX_ENTRIES"],
+    )
+    app.extensions["page_cache"] = cache
+    loaded = cache.load()
+    if loaded:
+        app.logger.debug("Loaded %d pre-rendered page(s)", loaded)
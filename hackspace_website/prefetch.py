@@ -0,0 +1,218 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import fcntl
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from hackspace_website.rewrite import rewrite_html
+
+logger = logging.getLogger(__name__)
+
+# Blog posts are stored twice: the raw CMS JSON under its URL, like any
+# other CMS response, and ready to render under this prefix + URL. All of
+# it is pinned in the cache so however many posts there are, none of them
+# (or the last run time) get evicted by on-demand entries or each other.
+RENDERED_PREFIX = "rendered:"
+SLUGS_KEY = "prefetch:slugs"
+LAST_RUN_KEY = "prefetch:last_run"
+
+PREFETCH_MODES = ("off", "thread", "external")
+
+# Page size asked for when walking a paginated list, DRF caps it anyway
+LIST_FETCH_PAGE_SIZE = 100
+
+
+class Prefetcher:
+    """Pulls the open day page, the blog list and every post from the CMS
+    on a schedule, so page views only ever read the cache.
+
+    Post details are fetched concurrently on a small thread pool and their
+    bodies rewritten once here rather than on first view. With the SQLite
+    cache backend all workers share the results, so an flock and the time of
+    the last run make sure only one of them does the work each interval.
+    """
+
+    def __init__(self, app, interval: float, workers: int, lock_path: str | None):
+        self.app = app
+        self.interval = interval
+        self.workers = workers
+        self.lock_path = lock_path
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def run_once(self) -> dict:
+        with self.app.app_context():
+            cfg = current_app.config
+            cache = current_app.extensions["cms_cache"]
+            stats = {"posts": 0, "failed": 0, "removed": 0}
+
+            try:
+                cache.store(cfg["CMS_OPEN_DAY_URL"], cache.fetch(cfg["CMS_OPEN_DAY_URL"]), pinned=True)
+            except Exception:
+                logger.warning("Prefetching the open day page failed", exc_info=True)
+
+            # If the list can't be fetched keep everything we have
+            posts = fetch_blog_list(cache)
+            cache.store(cfg["CMS_BLOG_LIST_URL"], posts, pinned=True)
+
+            urls = {
+                post["slug"]: cfg["CMS_BLOG_DETAIL_URL"].format(slug=post["slug"])
+                for post in posts if post.get("slug")
+            }
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cms-prefetch") as pool:
+                futures = {pool.submit(cache.fetch, url): url for url in urls.values()}
+                for future in as_completed(futures):
+                    url = futures[future]
+                    try:
+                        post = future.result()
+                    except Exception:
+                        logger.warning("Prefetching %s failed", url, exc_info=True)
+                        stats["failed"] += 1
+                        continue
+                    store_post(cache, url, post)
+                    stats["posts"] += 1
+
+            # Drop posts that have been unpublished since the last run
+            for slug in set(cache.peek(SLUGS_KEY) or ()) - urls.keys():
+                url = cfg["CMS_BLOG_DETAIL_URL"].format(slug=slug)
+                cache.invalidate(url)
+                cache.invalidate(RENDERED_PREFIX + url)
+                stats["removed"] += 1
+            cache.store(SLUGS_KEY, sorted(urls), pinned=True)
+            cache.store(LAST_RUN_KEY, time.time(), pinned=True)
+            return stats
+
+    def run_if_due(self):
+        with self.app.app_context():
+            last_run = current_app.extensions["cms_cache"].peek(LAST_RUN_KEY)
+        if last_run is not None and time.time() - last_run < self.interval * 0.9:
+            return None  # another worker got there first
+        if self.lock_path is None:
+            return self.run_once()
+
+        with open(self.lock_path, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            return self.run_once()
+
+    def run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                stats = self.run_if_due()
+                if stats is not None:
+                    logger.info("Prefetched CMS content: %s", stats)
+            except Exception:
+                logger.warning("CMS prefetch failed", exc_info=True)
+            time.sleep(max(1.0, self.interval - (time.monotonic() - started)))
+
+    def ensure_thread(self):
+        # Started from the first request so it's running in each worker
+        # after gunicorn forks
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self.run, name="cms-prefetch", daemon=True).start()
+            self._pid = os.getpid()
+
+
+def list_page_url(page: int, per_page: int) -> str:
+    url = current_app.config["CMS_BLOG_LIST_URL"]
+    separator = "&" if "?" in url else "?"
+    return f"{url}{separator}{urlencode({'page': page, 'page_size': per_page})}"
+
+
+def fetch_blog_list(cache) -> list:
+    """The whole blog list from the CMS. A paginated list endpoint answers
+    in Django REST framework's format, {"count", "next", "results"}, so
+    follow `next` until the last page."""
+    if not current_app.config["CMS_BLOG_LIST_PAGINATED"]:
+        return cache.fetch(current_app.config["CMS_BLOG_LIST_URL"])
+
+    posts = []
+    url = list_page_url(1, LIST_FETCH_PAGE_SIZE)
+    seen = set()
+    while url and url not in seen:
+        seen.add(url)
+        data = cache.fetch(url)
+        posts.extend(data["results"])
+        url = data.get("next")
+    return posts
+
+
+def store_post(cache, url: str, post: dict):
+    cache.store(url, post, pinned=True)
+    rendered = dict(post)
+    rendered["body_html"] = rewrite_html(post.get("body_html", ""))
+    cache.store(RENDERED_PREFIX + url, rendered, pinned=True)
+
+
+def cache_keys(url: str) -> list:
+    # Every key a CMS URL may be stored under
+    return [url, RENDERED_PREFIX + url]
+
+
+def _cache():
+    if "cms_prefetcher" not in current_app.extensions:
+        return None
+    return current_app.extensions["cms_cache"]
+
+
+def cached_json(url: str):
+    """The prefetched response for `url`, or None if prefetching is off or
+    hasn't got to it yet."""
+    cache = _cache()
+    return cache.peek(url) if cache is not None else None
+
+
+def rendered_post(url: str):
+    cache = _cache()
+    return cache.peek(RENDERED_PREFIX + url) if cache is not None else None
+
+
+cms_cli = AppGroup("cms", help="CMS content cache.")
+
+
+@cms_cli.command("prefetch")
+@click.option("--loop", is_flag=True, help="Keep running every CMS_PREFETCH_INTERVAL seconds.")
+def prefetch_command(loop):
+    """Fetch and render all CMS content into the cache."""
+    prefetcher = current_app.extensions.get("cms_prefetcher")
+    if prefetcher is None:
+        raise click.ClickException("CMS_PREFETCH is off")
+    if loop:
+        prefetcher.run()
+    else:
+        click.echo(prefetcher.run_once())
+
+
+def init_app(app):
+    cfg = app.config
+    mode = cfg["CMS_PREFETCH"]
+    if mode not in PREFETCH_MODES:
+        raise ValueError(f"CMS_PREFETCH must be one of {', '.join(PREFETCH_MODES)}")
+    app.cli.add_command(cms_cli)
+    if mode == "off":
+        return
+
+    lock_path = None
+    if cfg["CMS_CACHE_BACKEND"] == "sqlite":
+        lock_path = os.path.join(app.instance_path, "cms_prefetch.lock")
+        os.makedirs(app.instance_path, exist_ok=True)
+    elif mode == "external":
+        raise ValueError("CMS_PREFETCH = 'external' needs CMS_CACHE_BACKEND = 'sqlite' to share results")
+
+    prefetcher = Prefetcher(app, cfg["CMS_PREFETCH_INTERVAL"], cfg["CMS_PREFETCH_WORKERS"], lock_path)
+    app.extensions["cms_prefetcher"] = prefetcher
+    if mode == "thread":
+        app.before_request(prefetcher.ensure_thread)
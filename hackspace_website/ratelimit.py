@@ -0,0 +1,253 @@
+from datetime import datetime, timezone
+import ipaddress
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, render_template, request
+
+logger = logging.getLogger(__name__)
+
+
+class SlidingWindow:
+    """Sliding window counter over fixed windows.
+
+    Each key keeps a count for the current and previous window. The rate is
+    the current count plus the previous one weighted by how much of it still
+    overlaps the sliding window, which is close to an exact log of hits
+    while storing two numbers per key.
+    """
+
+    def __init__(self, window: float, limit: int):
+        self.window = window
+        self.limit = limit
+
+    def _estimate(self, now: float, start: float, current: int, previous: int) -> float:
+        overlap = 1 - (now - start) / self.window
+        return current + previous * overlap
+
+    def _retry_after(self, now: float, start: float, current: int, previous: int) -> int:
+        # Wait until the previous window has faded enough to fit one more hit
+        if previous:
+            needed = (current + previous + 1 - self.limit) / previous
+            wait = start + self.window * needed - now
+        else:
+            wait = start + self.window - now
+        return max(1, math.ceil(min(wait, start + 2 * self.window - now)))
+
+
+class MemoryRateLimiter(SlidingWindow):
+    # Per-process counts, so each gunicorn worker allows `limit` on its own.
+
+    def __init__(self, window: float, limit: int):
+        super().__init__(window, limit)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> tuple[bool, int]:
+        now = time.time()
+        start = now - now % self.window
+        with self._lock:
+            window_start, current, previous = self._counts.get(key, (start, 0, 0))
+            if window_start != start:
+                previous = current if window_start == start - self.window else 0
+                current = 0
+            if self._estimate(now, start, current, previous) + 1 > self.limit:
+                self._counts[key] = (start, current, previous)
+                return False, self._retry_after(now, start, current, previous)
+            self._counts[key] = (start, current + 1, previous)
+            if len(self._counts) > 10000:
+                self._prune(start)
+        return True, 0
+
+    def _prune(self, start: float):
+        for key in [k for k, v in self._counts.items() if v[0] < start - self.window]:
+            del self._counts[key]
+
+
+class SQLiteRateLimiter(SlidingWindow):
+    # Counts shared by every worker on the box through a small SQLite file.
+
+    PRUNE_INTERVAL = 300
+
+    def __init__(self, path: str, window: float, limit: int):
+        super().__init__(window, limit)
+        self.path = path
+        self._local = threading.local()
+        self._last_prune = 0.0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ratelimit ("
+                "key TEXT PRIMARY KEY, window_start REAL NOT NULL, "
+                "current INTEGER NOT NULL, previous INTEGER NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def hit(self, key: str) -> tuple[bool, int]:
+        now = time.time()
+        start = now - now % self.window
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT window_start, current, previous FROM ratelimit WHERE key = ?", (key,)
+            ).fetchone()
+            window_start, current, previous = row or (start, 0, 0)
+            if window_start != start:
+                previous = current if window_start == start - self.window else 0
+                current = 0
+
+            allowed = self._estimate(now, start, current, previous) + 1 <= self.limit
+            if allowed:
+                current += 1
+            conn.execute(
+                "INSERT OR REPLACE INTO ratelimit (key, window_start, current, previous) VALUES (?, ?, ?, ?)",
+                (key, start, current, previous),
+            )
+            if now - self._last_prune > self.PRUNE_INTERVAL:
+                conn.execute("DELETE FROM ratelimit WHERE window_start < ?", (start - self.window,))
+                self._last_prune = now
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        if allowed:
+            return True, 0
+        return False, self._retry_after(now, start, current, previous)
+
+
+class BanList:
+    """In-process copy of the banned_ip table.
+
+    Checked on every form request, so it's reloaded in the background every
+    `refresh_interval` seconds instead of querying the database each time.
+    Entries may be single addresses or networks in CIDR notation.
+    """
+
+    def __init__(self, app, refresh_interval: float):
+        self.app = app
+        self.refresh_interval = refresh_interval
+        self._addresses = {}
+        self._networks = []
+        self._loaded_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="ban-refresh", daemon=True).start()
+
+    def refresh(self):
+        import sqlalchemy as sa
+
+        from hackspace_website.models import BannedIp, db
+
+        try:
+            with self.app.app_context():
+                rows = db.session.execute(sa.select(BannedIp.ip_addr, BannedIp.expiry)).all()
+                db.session.remove()
+        except Exception:
+            logger.warning("Could not load banned IPs, keeping the old list", exc_info=True)
+            rows = None
+
+        if rows is not None:
+            addresses = {}
+            networks = []
+            for ip_addr, expiry in rows:
+                try:
+                    network = ipaddress.ip_network(ip_addr.strip(), strict=False)
+                except ValueError:
+                    logger.warning("Ignoring invalid banned IP %r", ip_addr)
+                    continue
+                if network.num_addresses == 1:
+                    addresses[network.network_address] = expiry
+                else:
+                    networks.append((network, expiry))
+            self._addresses, self._networks = addresses, networks
+
+        with self._lock:
+            # Also after a failure, so a down database isn't hit every request
+            self._loaded_at = time.monotonic()
+            self._refreshing = False
+
+    def is_banned(self, ip: str) -> bool:
+        self._maybe_refresh()
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if address in self._addresses:
+            expiry = self._addresses[address]
+            if expiry is None or expiry > now:
+                return True
+        return any(
+            address in network and (expiry is None or expiry > now)
+            for network, expiry in self._networks
+        )
+
+
+def check_request():
+    """before_request hook for the form blueprints. Turns away banned
+    addresses before any form parsing or Mosparo verification happens."""
+    bans = current_app.extensions.get("ban_list")
+    if bans is not None and bans.is_banned(request.remote_addr or ""):
+        return render_template("pages/contact_fail.html"), 403
+    return None
+
+
+def limit_submission():
+    """Count a submission that passed validation and Mosparo against the
+    sender's allowance, so a resubmitted form with an error doesn't use it
+    up. Returns the response to send instead once they're over it."""
+    limiter = current_app.extensions.get("rate_limiter")
+    if limiter is None:
+        return None
+    ip = request.remote_addr or ""
+    allowed, retry_after = limiter.hit(f"messages:{ip}")
+    if allowed:
+        return None
+    current_app.logger.info("Rate limited form submission from %s", ip)
+    return (
+        render_template("pages/rate_limited.html", retry_after=retry_after),
+        429,
+        {"Retry-After": str(retry_after)},
+    )
+
+
+def init_app(app):
+    cfg = app.config
+    if cfg["RATELIMIT_ENABLED"]:
+        window = cfg["MESSAGE_RATELIMIT_WINDOW"]
+        limit = cfg["MESSAGE_RATELIMIT_COUNT"]
+        if cfg["RATELIMIT_BACKEND"] == "sqlite":
+            path = cfg.get("RATELIMIT_PATH") or os.path.join(app.instance_path, "ratelimit.sqlite3")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            app.extensions["rate_limiter"] = SQLiteRateLimiter(path, window, limit)
+        else:
+            app.extensions["rate_limiter"] = MemoryRateLimiter(window, limit)
+
+    if cfg["BANNED_IP_ENABLED"]:
+        bans = BanList(app, cfg["BANNED_IP_REFRESH_INTERVAL"])
+        # Once up front, a worker that hasn't loaded the list yet would let
+        # everyone in. Later refreshes happen in the background.
+        bans.refresh()
+        app.extensions["ban_list"] = bans
@@ -0,0 +1,495 @@
+import re
+
+from flask import current_app, has_app_context
+
+from hackspace_website import media_variants, metrics
+
+
+YOUTUBE_ID_RE = re.compile(
+    r"(?:youtube\.com/watch\?v=|youtu\.be/)([A-Za-z0-9_-]{6,})"
+)
+
+MEDIA_ANYWHERE_RE = re.compile(
+    r"(/media/[^\"'<>\s]+\.(png|jpg|jpeg|gif|webp|svg))$",
+    re.IGNORECASE,
+)
+
+YOUTUBE_ALLOW = "accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture; web-share"
+
+
+def _public_media_base() -> str:
+    if not has_app_context():
+        return "/media"
+    return current_app.config.get("PUBLIC_MEDIA_URL", "/media/").rstrip("/")
+
+
+def _rewrite_to_public_media(url: str, public_base: str | None = None) -> str:
+    if not url:
+        return url
+
+    url = url.strip()
+    m = MEDIA_ANYWHERE_RE.search(url)
+    if not m:
+        return url
+
+    media_path = m.group(1)  # always starts with "/media/..."
+
+    if public_base is None:
+        public_base = _public_media_base()
+
+    # If PUBLIC_MEDIA_URL already ends with "/media", don't append "/media/..." again.
+    if public_base.endswith("/media"):
+        return f"{public_base}{media_path[len('/media'):]}"  # keep leading slash after /media
+        # e.g. base="http://x/media" + "/blog_body_images/a.png"
+    else:
+        return f"{public_base}{media_path}"
+
+
+class Node:
+    # Backend-neutral description of an element a stage wants to insert.
+
+    __slots__ = ("name", "attrs", "children")
+
+    def __init__(self, name: str, attrs: dict, children=()):
+        self.name = name
+        self.attrs = attrs
+        self.children = list(children)
+
+
+RASTER_IMAGE_RE = re.compile(r"\.(png|jpe?g|webp)$", re.IGNORECASE)
+
+
+def _srcset(src: str, widths) -> str:
+    return ", ".join(f"{src}?w={width} {width}w" for width in widths)
+
+
+def _make_img_tag(src: str, widths=(), sizes: str | None = None) -> Node:
+    attrs = {"alt": "", "class": "blog-body-image", "src": src}
+    if widths and RASTER_IMAGE_RE.search(src):
+        attrs["srcset"] = _srcset(src, widths)
+        attrs["sizes"] = sizes
+    return Node("img", attrs)
+
+
+def _youtube_iframe(video_id: str) -> Node:
+    return Node("div", {"class": "video-embed"}, [
+        Node("iframe", {
+            "allow": YOUTUBE_ALLOW,
+            "allowfullscreen": "",
+            "frameborder": "0",
+            "height": "315",
+            "referrerpolicy": "strict-origin-when-cross-origin",
+            "src": f"https://www.youtube.com/embed/{video_id}",
+            "title": "YouTube video player",
+            "width": "560",
+        }),
+    ])
+
+
+class RewriteContext:
+    # Per-document state handed to every stage.
+
+    def __init__(self, public_base: str):
+        self.public_base = public_base
+
+
+class Rewriter:
+    """A stage of the blog body rewrite.
+
+    `element` is called with the name and (mutable) attributes of every tag
+    and `text` with every plain text node. Returning a `Node` replaces the
+    original, and a replaced element's children are not visited. Returning
+    None leaves it for the next stage.
+    """
+
+    def element(self, name: str, attrs: dict, ctx: RewriteContext):
+        return None
+
+    def text(self, text: str, ctx: RewriteContext):
+        return None
+
+
+class MediaRewriter(Rewriter):
+    """Point CMS media at PUBLIC_MEDIA_URL and turn links to images into images.
+
+    With `variant_widths` set, raster images also get a `srcset` of resized
+    copies (`?w=<width>` on the media proxy) so browsers can pick one that
+    fits the screen.
+    """
+
+    def __init__(self, variant_widths=(), sizes: str | None = None):
+        self.variant_widths = tuple(variant_widths)
+        self.sizes = sizes
+
+    def element(self, name, attrs, ctx):
+        if name == "img" and attrs.get("src"):
+            new_src = _rewrite_to_public_media(attrs["src"], ctx.public_base)
+            attrs["src"] = new_src
+            if (self.variant_widths and "srcset" not in attrs
+                    and MEDIA_ANYWHERE_RE.search(new_src) and RASTER_IMAGE_RE.search(new_src)):
+                attrs["srcset"] = _srcset(new_src, self.variant_widths)
+                attrs.setdefault("sizes", self.sizes)
+        elif name == "a" and attrs.get("href"):
+            href = attrs["href"].strip()
+            new_src = _rewrite_to_public_media(href, ctx.public_base)
+            if new_src != href:
+                return _make_img_tag(new_src, self.variant_widths, self.sizes)
+        return None
+
+    def text(self, text, ctx):
+        stripped = text.strip()
+        if "/media/" not in stripped:
+            return None
+        new_src = _rewrite_to_public_media(stripped, ctx.public_base)
+        if new_src == stripped:
+            return None
+        return _make_img_tag(new_src, self.variant_widths, self.sizes)
+
+
+class YouTubeRewriter(Rewriter):
+    # Replace YouTube links, wrapped in <a> or bare, with an embedded player.
+
+    def element(self, name, attrs, ctx):
+        if name != "a" or not attrs.get("href"):
+            return None
+        m = YOUTUBE_ID_RE.search(attrs["href"])
+        if not m:
+            return None
+        return _youtube_iframe(m.group(1))
+
+    def text(self, text, ctx):
+        if "youtu" not in text:
+            return None
+        m = YOUTUBE_ID_RE.search(text)
+        if not m:
+            return None
+        return _youtube_iframe(m.group(1))
+
+
+class RewritePipeline:
+    """Parses a body once with BeautifulSoup, runs every registered stage
+    over it in a single walk of the tree and serializes the result once."""
+
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+
+    def register(self, stage: Rewriter):
+        self.stages.append(stage)
+
+    def _element(self, name, attrs, ctx):
+        for stage in self.stages:
+            replacement = stage.element(name, attrs, ctx)
+            if replacement is not None:
+                return replacement
+        return None
+
+    def _text(self, text, ctx):
+        for stage in self.stages:
+            replacement = stage.text(text, ctx)
+            if replacement is not None:
+                return replacement
+        return None
+
+    def rewrite(self, html: str, public_base: str | None = None) -> str:
+        if not html:
+            return html
+        if public_base is None:
+            public_base = _public_media_base()
+
+        # bs4 takes about as long to import as the rest of the app, so it
+        # waits until there's a body to rewrite
+        from bs4 import BeautifulSoup, NavigableString, Tag
+
+        soup = BeautifulSoup(html, "lxml")
+        ctx = RewriteContext(public_base)
+
+        stack = [soup]
+        while stack:
+            node = stack.pop()
+            # Iterate over a snapshot as stages may replace the current child
+            for child in list(node.contents):
+                if isinstance(child, Tag):
+                    replacement = self._element(child.name, child.attrs, ctx)
+                    if replacement is None:
+                        stack.append(child)
+                        continue
+                elif type(child) is NavigableString:
+                    replacement = self._text(child, ctx)
+                    if replacement is None:
+                        continue
+                else:
+                    continue
+                child.replace_with(self._to_tag(soup, replacement))
+
+        # lxml wraps fragments in <html><body>; return body contents if present
+        return (soup.body or soup).decode_contents()
+
+    def _to_tag(self, soup, node: Node):
+        tag = soup.new_tag(node.name, attrs=node.attrs)
+        for child in node.children:
+            tag.append(self._to_tag(soup, child) if isinstance(child, Node) else child)
+        return tag
+
+
+# The streaming backend has to serialize exactly like BeautifulSoup's
+# "minimal" formatter does, so these mirror bs4's HTMLTreeBuilder defaults.
+VOID_ELEMENTS = frozenset({
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link",
+    "menuitem", "meta", "param", "source", "track", "wbr", "basefont", "bgsound",
+    "command", "frame", "image", "isindex", "nextid", "spacer",
+})
+STRING_CONTAINER_ELEMENTS = frozenset({"rt", "rp", "style", "script", "template"})
+CDATA_ELEMENTS = frozenset({"script", "style"})
+PRESERVE_WHITESPACE_ELEMENTS = frozenset({"pre", "textarea"})
+MULTI_VALUED_ATTRIBUTES = {
+    "*": {"class", "accesskey", "dropzone"},
+    "a": {"rel", "rev"},
+    "link": {"rel", "rev"},
+    "td": {"headers"},
+    "th": {"headers"},
+    "form": {"accept-charset"},
+    "object": {"archive"},
+    "area": {"rel"},
+    "icon": {"sizes"},
+    "iframe": {"sandbox"},
+    "output": {"for"},
+}
+ASCII_SPACES = frozenset("\x20\x0a\x09\x0c\x0d")
+NON_WHITESPACE_RE = re.compile(r"\S+")
+
+
+def _escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _quote_attr(value: str) -> str:
+    value = _escape(value)
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"' + value.replace('"', "&quot;") + '"'
+
+
+def _start_tag(name: str, attrs: dict) -> str:
+    parts = [name]
+    for key, value in sorted(attrs.items()):
+        if value is None:
+            parts.append(key)
+            continue
+        if isinstance(value, list):
+            value = " ".join(value)
+        parts.append(f"{key}={_quote_attr(value)}")
+    close = "/>" if name in VOID_ELEMENTS else ">"
+    return "<" + " ".join(parts) + close
+
+
+def _serialize(node: Node) -> str:
+    if node.name in VOID_ELEMENTS and not node.children:
+        return _start_tag(node.name, node.attrs)
+    inner = "".join(
+        _serialize(child) if isinstance(child, Node) else _escape(child)
+        for child in node.children
+    )
+    return f"{_start_tag(node.name, node.attrs)}{inner}</{node.name}>"
+
+
+class _StreamTarget:
+    # lxml parser target that writes rewritten markup as parse events arrive,
+    # without ever building a tree.
+
+    def __init__(self, pipeline, ctx):
+        self.pipeline = pipeline
+        self.ctx = ctx
+        self.head = []  # anything seen before <body>, dropped if a body turns up
+        self.body = None
+        self.body_closed = False
+        self.text = []
+        self.open = []
+        self.containers = 0
+        self.preserve = 0
+        self.skip_depth = 0
+
+    def _write(self, piece: str):
+        if self.body_closed:
+            return
+        (self.head if self.body is None else self.body).append(piece)
+
+    def drain(self) -> str:
+        if self.body is None:
+            return ""
+        out = "".join(self.body)
+        self.body.clear()
+        return out
+
+    def _flush_text(self):
+        if not self.text:
+            return
+        text = "".join(self.text)
+        self.text.clear()
+        if self.skip_depth:
+            return
+
+        if not self.preserve and all(c in ASCII_SPACES for c in text):
+            text = "\n" if "\n" in text else " "
+
+        if not self.containers:
+            replacement = self.pipeline._text(text, self.ctx)
+            if replacement is not None:
+                self._write(_serialize(replacement))
+                return
+        if self.open and self.open[-1] in CDATA_ELEMENTS:
+            self._write(text)
+        else:
+            self._write(_escape(text))
+
+    def start(self, tag, attrib):
+        self._flush_text()
+        if self.skip_depth:
+            self.skip_depth += 1
+            return
+
+        if tag == "body" and self.body is None:
+            self.body = []
+            self.open.append(tag)
+            return
+
+        attrs = {}
+        for key, value in attrib.items():
+            if key in MULTI_VALUED_ATTRIBUTES["*"] or key in MULTI_VALUED_ATTRIBUTES.get(tag, ()):
+                value = NON_WHITESPACE_RE.findall(value)
+            attrs[key] = value
+
+        replacement = self.pipeline._element(tag, attrs, self.ctx)
+        if replacement is not None:
+            self._write(_serialize(replacement))
+            self.skip_depth = 1
+            return
+
+        self._write(_start_tag(tag, attrs))
+        self.open.append(tag)
+        if tag in STRING_CONTAINER_ELEMENTS:
+            self.containers += 1
+        if tag in PRESERVE_WHITESPACE_ELEMENTS:
+            self.preserve += 1
+
+    def end(self, tag):
+        self._flush_text()
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+
+        self.open.pop()
+        if tag == "body" and not self.body_closed and self.body is not None:
+            self.body_closed = True
+            return
+        if tag in STRING_CONTAINER_ELEMENTS:
+            self.containers -= 1
+        if tag in PRESERVE_WHITESPACE_ELEMENTS:
+            self.preserve -= 1
+        if tag not in VOID_ELEMENTS:
+            self._write(f"</{tag}>")
+
+    def data(self, data):
+        self.text.append(data)
+
+    def comment(self, text):
+        self._flush_text()
+        if not self.skip_depth:
+            self._write(f"<!--{text}-->")
+
+    def pi(self, target, data):
+        self._flush_text()
+        if not self.skip_depth:
+            self._write(f"<?{target} {data}>")
+
+    def doctype(self, name, pubid, system):
+        self._flush_text()
+
+    def close(self):
+        self._flush_text()
+        if self.body is None:
+            # No <body> was ever opened, so everything counts as content
+            self.body = self.head
+            self.head = []
+
+
+class StreamingRewritePipeline(RewritePipeline):
+    """Same stages and output as RewritePipeline, but driven by lxml parser
+    events so no document tree is held in memory. Large bodies can be fed in
+    chunks through `rewrite_iter`."""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def rewrite(self, html: str, public_base: str | None = None) -> str:
+        if not html:
+            return html
+        chunks = (html[i:i + self.CHUNK_SIZE] for i in range(0, len(html), self.CHUNK_SIZE))
+        return "".join(self.rewrite_iter(chunks, public_base))
+
+    def rewrite_iter(self, chunks, public_base: str | None = None):
+        if public_base is None:
+            public_base = _public_media_base()
+
+        from lxml import etree
+
+        target = _StreamTarget(self, RewriteContext(public_base))
+        parser = etree.HTMLParser(target=target, recover=True)
+        for chunk in chunks:
+            parser.feed(chunk)
+            out = target.drain()
+            if out:
+                yield out
+        parser.close()
+        out = target.drain()
+        if out:
+            yield out
+
+
+REWRITER_BACKENDS = {
+    "soup": RewritePipeline,
+    "lxml": StreamingRewritePipeline,
+}
+
+
+def _pipeline_class():
+    if not has_app_context():
+        return RewritePipeline
+    return REWRITER_BACKENDS[current_app.config.get("HTML_REWRITER_BACKEND", "soup")]
+
+
+def default_pipeline(backend: str = "soup", variant_widths=(), sizes: str | None = None) -> RewritePipeline:
+    return REWRITER_BACKENDS[backend]([MediaRewriter(variant_widths, sizes), YouTubeRewriter()])
+
+
+def init_app(app):
+    cfg = app.config
+    variant_widths = cfg["MEDIA_VARIANT_WIDTHS"] if media_variants.enabled(cfg) else ()
+    app.extensions["html_rewriter"] = default_pipeline(
+        cfg["HTML_REWRITER_BACKEND"], variant_widths, cfg["MEDIA_VARIANT_SIZES"]
+    )
+
+
+def register_rewriter(app, stage: Rewriter):
+    app.extensions["html_rewriter"].register(stage)
+
+
+def rewrite_html(html: str) -> str:
+    with metrics.span("rewrite"):
+        return current_app.extensions["html_rewriter"].rewrite(html)
+
+
+def embed_youtube_links(html: str) -> str:
+    with metrics.span("rewrite"):
+        return _pipeline_class()([YouTubeRewriter()]).rewrite(html)
+
+
+def _variant_settings():
+    if not has_app_context() or not media_variants.enabled(current_app.config):
+        return (), None
+    return current_app.config["MEDIA_VARIANT_WIDTHS"], current_app.config["MEDIA_VARIANT_SIZES"]
+
+
+def embed_cms_images(html: str, cms_base_url: str) -> str:
+    with metrics.span("rewrite"):
+        return _pipeline_class()([MediaRewriter(*_variant_settings())]).rewrite(html)
@@ -0,0 +1,147 @@
+import atexit
+from datetime import datetime, timezone
+import logging
+import os
+import queue
+import threading
+import time
+
+import click
+from flask import current_app, request
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """Records form submissions in the `message` table without making the
+    request wait for the database.
+
+    Rows go onto an in-memory queue and a background thread inserts them in
+    batches of up to `batch_size`, waiting at most `flush_interval` seconds
+    for a batch to fill. Anything still queued is written at exit. The
+    email for a submission is queued separately, so losing a batch here
+    never loses the submission itself.
+    """
+
+    RETRIES = 3
+
+    def __init__(self, app, batch_size: int, flush_interval: float, max_queue: int):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _ensure_thread(self):
+        # As with the mail sender, a thread started before gunicorn forks
+        # doesn't exist in the worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="message-writer", daemon=True).start()
+            self._pid = os.getpid()
+
+    def record(self, row: dict):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            logger.error("Message queue is full, not storing submission %r", row["subject"])
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._write(self._next_batch())
+
+    def _write(self, batch: list):
+        import sqlalchemy as sa
+        from sqlalchemy.exc import SQLAlchemyError
+
+        from hackspace_website.models import Message, db
+
+        for attempt in range(1, self.RETRIES + 1):
+            with self.app.app_context():
+                try:
+                    # One multi-row INSERT for the whole batch
+                    db.session.execute(sa.insert(Message), batch)
+                    db.session.commit()
+                    return
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    if attempt == self.RETRIES:
+                        logger.exception("Dropping %d submission(s), the database is unavailable", len(batch))
+                        return
+                    logger.warning("Storing submissions failed, retrying", exc_info=True)
+            time.sleep(attempt)
+
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+
+def _truncate(value: str | None, column) -> str:
+    value = value or ""
+    return value[:column.type.length] if column.type.length else value
+
+
+def record_message(name: str, email: str | None, subject: str, message: str):
+    writer = current_app.extensions.get("message_writer")
+    if writer is None:
+        return
+
+    from hackspace_website.models import Message
+
+    columns = Message.__table__.c
+    writer.record({
+        "name": _truncate(name, columns.name),
+        "email": _truncate(email, columns.email),
+        "subject": _truncate(subject, columns.subject),
+        "message": message,
+        "ip_addr": _truncate(request.remote_addr, columns.ip_addr),
+        "user_agent": _truncate(request.user_agent.string, columns.user_agent),
+        "honeypot_triggered": False,
+        "received": datetime.now(timezone.utc).replace(tzinfo=None),
+    })
+
+
+def init_app(app):
+    cfg = app.config
+    # Flask-SQLAlchemy and Alembic take longer to import than the rest of
+    # the app together, so they're only loaded when something uses the
+    # database: the message store, the ban list or a command like `flask db`
+    if not (cfg["MESSAGE_STORE_ENABLED"] or cfg["BANNED_IP_ENABLED"] or click.get_current_context(silent=True)):
+        return
+
+    from hackspace_website.models import db, migrate
+
+    db.init_app(app)
+    migrate.init_app(app, db)
+    if cfg["MESSAGE_STORE_ENABLED"]:
+        app.extensions["message_writer"] = MessageWriter(
+            app,
+            batch_size=app.config["MESSAGE_STORE_BATCH_SIZE"],
+            flush_interval=app.config["MESSAGE_STORE_FLUSH_INTERVAL"],
+            max_queue=app.config["MESSAGE_STORE_MAX_QUEUE"],
+        )
@@ -6,9 +6,10 @@ from markupsafe import Markup
 from wtforms import BooleanField, StringField, EmailField, TextAreaField
 from wtforms.validators import DataRequired, InputRequired, Length
 
-from hackspace_website import mailer, mosparo
+from hackspace_website import mailer, mosparo, ratelimit, submissions
 
 bp = Blueprint('contact', __name__, url_prefix="/contact")
+bp.before_request(ratelimit.check_request)
 
 class ContactForm(FlaskForm):
         name = StringField(
@@ -42,8 +43,17 @@ def index():
     if request.method == "POST":
         if mosparo.verify_formdata():
             if form.validate_on_submit():
+                    limited = ratelimit.limit_submission()
+                    if limited is not None:
+                         return limited
                     text = f"{form.name.data.strip()} just sent a message through the contact form:\n\n" + form.message.data
 
+                    submissions.record_message(
+                         name=form.name.data.strip(),
+                         email=form.email.data.strip(),
+                         subject=form.subject.data.strip(),
+                         message=form.message.data,
+                    )
                     mailer.send_internal(
                          reply_to=form.email.data.strip(),
                          subject=f"New message via contact form: {form.subject.data.strip()}",
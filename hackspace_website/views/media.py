@@ -0,0 +1,557 @@
+from collections import Counter
+from datetime import datetime, timezone
+from functools import lru_cache
+import mimetypes
+import os
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+from flask import (
+    Blueprint, Response, abort, current_app, redirect, request, send_file, stream_with_context
+)
+from werkzeug.http import http_date, is_resource_modified
+
+from hackspace_website import media_variants, metrics
+from hackspace_website.cache import LRUCache, SingleFlight
+from hackspace_website.media_cache import CachedMedia, MediaCache
+
+bp = Blueprint('media', __name__)
+
+DELIVERY_MODES = ("proxy", "accel", "sendfile", "redirect")
+
+
+@bp.record_once
+def init_media(state):
+    app = state.app
+    if app.config["MEDIA_DELIVERY"] not in DELIVERY_MODES:
+        raise ValueError(f"MEDIA_DELIVERY must be one of {', '.join(DELIVERY_MODES)}")
+    app.extensions["media_metadata"] = LRUCache(
+        maxsize=app.config["MEDIA_METADATA_CACHE_SIZE"]
+    )
+    app.extensions["media_missing"] = LRUCache(
+        maxsize=app.config["MEDIA_NEGATIVE_CACHE_SIZE"]
+    )
+    app.extensions["media_flights"] = SingleFlight()
+    app.extensions["media_presigned"] = LRUCache(
+        maxsize=app.config["MEDIA_METADATA_CACHE_SIZE"]
+    )
+    app.extensions["media_stats"] = (Counter(), threading.Lock())
+    if app.config["MEDIA_CACHE_ENABLED"]:
+        app.extensions["media_cache"] = MediaCache(
+            app.config.get("MEDIA_CACHE_DIR") or os.path.join(app.instance_path, "media-cache"),
+            max_bytes=app.config["MEDIA_CACHE_MAX_BYTES"],
+            max_object_bytes=app.config["MEDIA_CACHE_MAX_OBJECT_BYTES"],
+            revalidate_after=app.config["MEDIA_CACHE_REVALIDATE_AFTER"],
+        )
+
+
+# One client for the bucket and one for the URL browsers are sent to
+@lru_cache(maxsize=2)
+def _s3_client_cached(endpoint_url, access_key, secret_key, region, max_connections):
+    # boto3 is slow to import and most requests never reach the bucket
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        region_name=region,
+        config=Config(s3={"addressing_style": "path"}, max_pool_connections=max_connections),
+    )
+
+def _s3_client(endpoint_url: str | None = None):
+    cfg = current_app.config
+    return _s3_client_cached(
+        endpoint_url or cfg["AWS_S3_ENDPOINT_URL"],
+        cfg["AWS_ACCESS_KEY_ID"],
+        cfg["AWS_SECRET_ACCESS_KEY"],
+        cfg.get("AWS_S3_REGION_NAME", "garage"),
+        # Raise along with GUNICORN_WORKER_CONNECTIONS under gevent, or
+        # connections past this are opened and thrown away every request
+        cfg.get("AWS_S3_MAX_POOL_CONNECTIONS", 10),
+    )
+
+
+def _error_code(e) -> str:
+    return e.response.get("Error", {}).get("Code", "")
+
+
+def _metadata(obj: dict, key: str) -> dict:
+    return {
+        "etag": obj.get("ETag"),
+        "last_modified": obj.get("LastModified"),
+        # For partial responses this is the object size, not the range length
+        "size": _size_from_content_range(obj.get("ContentRange")) or obj.get("ContentLength"),
+        # content-type: prefer what S3 reports, else guesstimate
+        "content_type": obj.get("ContentType") or mimetypes.guess_type(key)[0] or "application/octet-stream",
+    }
+
+
+def _size_from_content_range(content_range: str | None) -> int | None:
+    # "bytes 0-99/1234" -> 1234
+    if not content_range or "/" not in content_range:
+        return None
+    total = content_range.rsplit("/", 1)[1]
+    return int(total) if total.isdigit() else None
+
+
+def _head(bucket: str, s3_key: str, key: str) -> dict:
+    # Revalidation requests only need the ETag and dates, so keep those around
+    # briefly instead of asking the bucket every time.
+    cache = current_app.extensions["media_metadata"]
+    entry = cache.get(s3_key)
+    if entry is not None and time.time() - entry[1] < current_app.config["MEDIA_METADATA_TTL"]:
+        return entry[0]
+
+    # botocore is only loaded by the first request that needs the bucket
+    from botocore.exceptions import ClientError
+
+    _count("upstream_requests")
+    try:
+        with metrics.span("s3"):
+            obj = _s3_client().head_object(Bucket=bucket, Key=s3_key)
+    except ClientError as e:
+        if _error_code(e) in ("NoSuchKey", "404", "NotFound"):
+            _remember_missing(s3_key)
+            abort(404)
+        abort(502)
+
+    meta = _metadata(obj, key)
+    cache.set(s3_key, (meta, time.time()))
+    return meta
+
+
+def _base_headers(meta: dict) -> dict:
+    headers = {
+        "Content-Type": meta["content_type"],
+        # cache aggressively for public blog images (adjust if you want)
+        "Cache-Control": f"public, max-age={int(current_app.config['MEDIA_MAX_AGE'])}",
+        "Accept-Ranges": "bytes",
+    }
+    if meta["etag"]:
+        headers["ETag"] = meta["etag"]
+    if meta["last_modified"]:
+        headers["Last-Modified"] = http_date(meta["last_modified"])
+    return headers
+
+
+def _if_range_matches(meta: dict) -> bool:
+    if_range = request.if_range
+    if if_range.etag:
+        return meta["etag"] is not None and if_range.etag == meta["etag"].strip('"')
+    if if_range.date:
+        return meta["last_modified"] is not None and meta["last_modified"] <= if_range.date
+    return True
+
+
+def _count(name: str, n: int = 1):
+    stats, lock = current_app.extensions["media_stats"]
+    with lock:
+        stats[name] += n
+
+
+def stats() -> dict:
+    counts, lock = current_app.extensions["media_stats"]
+    with lock:
+        snapshot = dict(counts)
+    snapshot["upstream_saved"] = sum(snapshot.get(name, 0) for name in (
+        "cache_hits", "coalesced_in_worker", "coalesced_between_workers", "negative_hits",
+    ))
+    return snapshot
+
+
+def _is_known_missing(s3_key: str) -> bool:
+    expires = current_app.extensions["media_missing"].get(s3_key)
+    return expires is not None and expires > time.time()
+
+
+def _remember_missing(s3_key: str):
+    current_app.extensions["media_missing"].set(
+        s3_key, time.time() + current_app.config["MEDIA_NEGATIVE_TTL"]
+    )
+
+
+def _send_cached(entry: CachedMedia, cache_status: str) -> Response:
+    delivery = current_app.config["MEDIA_DELIVERY"]
+    if delivery in ("accel", "sendfile"):
+        return _hand_off_cached(entry, cache_status, delivery)
+
+    # send_file hands the open file to the server's wsgi.file_wrapper, so
+    # gunicorn can use sendfile() instead of copying chunks through Python.
+    # It also takes care of conditional and range requests for us.
+    meta = entry.meta
+    last_modified = meta["last_modified"]
+    response = send_file(
+        entry.path,
+        mimetype=meta["content_type"],
+        conditional=True,
+        etag=meta["etag"].strip('"') if meta["etag"] else False,
+        last_modified=datetime.fromtimestamp(last_modified, timezone.utc) if last_modified else None,
+        max_age=int(current_app.config["MEDIA_MAX_AGE"]),
+    )
+    response.cache_control.public = True
+    response.headers["X-Cache"] = cache_status
+    return response
+
+
+def _hand_off_cached(entry: CachedMedia, cache_status: str, delivery: str) -> Response:
+    # The front server reads the file and answers range requests itself, we
+    # only answer revalidations and say which file
+    os.stat(entry.path)  # FileNotFoundError if evicted, same as send_file
+    meta = entry.meta
+    response = Response(mimetype=meta["content_type"])
+    if meta["etag"]:
+        response.set_etag(meta["etag"].strip('"'))
+    if meta["last_modified"]:
+        response.last_modified = meta["last_modified"]
+    response.cache_control.public = True
+    response.cache_control.max_age = int(current_app.config["MEDIA_MAX_AGE"])
+    response.headers["X-Cache"] = cache_status
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    _count("handed_off")
+    if delivery == "sendfile":
+        response.headers["X-Sendfile"] = os.path.abspath(entry.path)
+    else:
+        cache = current_app.extensions["media_cache"]
+        relative = os.path.relpath(entry.path, cache.directory).replace(os.sep, "/")
+        response.headers["X-Accel-Redirect"] = current_app.config["MEDIA_ACCEL_CACHE_PREFIX"] + quote(relative)
+    return response
+
+
+def _presigned_url(bucket: str, s3_key: str, endpoint_url: str | None = None) -> tuple[str, float]:
+    # Signing is cheap, but every signature is a new URL which browsers
+    # can't cache, so each one is reused for the first half of its life.
+    # Returns the URL and when it expires.
+    expires = int(current_app.config["MEDIA_PRESIGN_EXPIRES"])
+    cache = current_app.extensions["media_presigned"]
+    entry = cache.get((endpoint_url, s3_key))
+    now = time.time()
+    if entry is not None and entry[1] - now > expires / 2:
+        return entry
+
+    url = _s3_client(endpoint_url).generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": s3_key}, ExpiresIn=expires
+    )
+    entry = (url, now + expires)
+    cache.set((endpoint_url, s3_key), entry)
+    return entry
+
+
+def _accel_s3(bucket: str, s3_key: str) -> Response:
+    # nginx fetches it from the bucket with a presigned URL through the
+    # internal location, passing on ranges and revalidations
+    url, _ = _presigned_url(bucket, s3_key)
+    parts = urlsplit(url)
+    response = Response()
+    response.headers["X-Accel-Redirect"] = (
+        current_app.config["MEDIA_ACCEL_S3_PREFIX"] + parts.path.lstrip("/") + "?" + parts.query
+    )
+    response.cache_control.public = True
+    response.cache_control.max_age = int(current_app.config["MEDIA_MAX_AGE"])
+    _count("handed_off")
+    return response
+
+
+def _redirect_presigned(bucket: str, s3_key: str) -> Response:
+    cfg = current_app.config
+    url, expires_at = _presigned_url(bucket, s3_key, cfg["MEDIA_PRESIGN_ENDPOINT_URL"])
+    response = redirect(url, 302)
+    # Only until a new URL would be signed, so the image is still fetched
+    # and cached under the same one
+    response.cache_control.private = True
+    response.cache_control.max_age = max(0, int(expires_at - cfg["MEDIA_PRESIGN_EXPIRES"] / 2 - time.time()))
+    _count("redirected")
+    return response
+
+
+def _fill(cache: MediaCache, bucket: str, s3_key: str, key: str):
+    # Returns (CachedMedia, cache status) or, for objects too big to cache,
+    # the open get_object response.
+    with cache.fill_lock(s3_key, current_app.config["MEDIA_FILL_LOCK_TIMEOUT"]):
+        # Another worker may have fetched it while we waited for the lock
+        entry = cache.get(s3_key)
+        if entry is not None and not cache.is_stale(entry):
+            _count("coalesced_between_workers")
+            return entry, "HIT"
+
+        params = {"Bucket": bucket, "Key": s3_key}
+        if entry is not None and entry.meta["etag"]:
+            params["IfNoneMatch"] = entry.meta["etag"]
+
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        _count("upstream_requests")
+        try:
+            with metrics.span("s3"):
+                obj = _s3_client().get_object(**params)
+        except ClientError as e:
+            code = _error_code(e)
+            if entry is not None and code in ("304", "NotModified"):
+                cache.mark_fresh(s3_key, entry)
+                return entry, "REVALIDATED"
+            if code in ("NoSuchKey", "404"):
+                cache.delete(s3_key)
+                _remember_missing(s3_key)
+                abort(404)
+            if entry is not None:
+                current_app.logger.warning("Revalidating %s failed, serving cached copy", s3_key)
+                return entry, "STALE"
+            abort(502)
+        except BotoCoreError:
+            if entry is None:
+                raise
+            current_app.logger.warning("Revalidating %s failed, serving cached copy", s3_key, exc_info=True)
+            return entry, "STALE"
+
+        if obj["ContentLength"] > cache.max_object_bytes:
+            return obj
+
+        meta = _metadata(obj, key)
+        last_modified = meta["last_modified"]
+        entry = cache.put(s3_key, obj["Body"].iter_chunks(chunk_size=64 * 1024), {
+            "etag": meta["etag"],
+            "last_modified": last_modified.timestamp() if last_modified else None,
+            "content_type": meta["content_type"],
+        })
+        return entry, "MISS"
+
+
+def _fill_shared(cache: MediaCache, bucket: str, s3_key: str, key: str):
+    # Concurrent requests for the same key in this worker wait for one fetch
+    flights = current_app.extensions["media_flights"]
+    result, shared = flights.do(s3_key, lambda: _fill(cache, bucket, s3_key, key))
+    if shared:
+        _count("coalesced_in_worker")
+    return result, shared
+
+
+def _serve_from_cache(cache: MediaCache, bucket: str, s3_key: str, key: str) -> Response:
+    entry = cache.get(s3_key)
+    if entry is not None and not cache.is_stale(entry):
+        try:
+            response = _send_cached(entry, "HIT")
+            _count("cache_hits")
+            return response
+        except FileNotFoundError:
+            pass  # evicted since we looked it up
+
+    result, shared = _fill_shared(cache, bucket, s3_key, key)
+    if isinstance(result, tuple):
+        entry, cache_status = result
+        return _send_cached(entry, "COALESCED" if shared else cache_status)
+    return _stream_uncached(result, shared, bucket, s3_key, key)
+
+
+def _stream_uncached(obj: dict, shared: bool, bucket: str, s3_key: str, key: str) -> Response:
+    # Too big for the cache. The body can only be read once, so anyone who
+    # waited on the leader has to fetch their own copy.
+    if current_app.config["MEDIA_DELIVERY"] == "accel":
+        if not shared:
+            obj["Body"].close()
+        return _accel_s3(bucket, s3_key)
+    if shared:
+        _count("upstream_requests")
+        with metrics.span("s3"):
+            obj = _s3_client().get_object(Bucket=bucket, Key=s3_key)
+    return _stream_response(obj, _metadata(obj, key))
+
+
+def _requested_variant():
+    # ?w=640 asks for a resized copy, &fm=webp picks the format, otherwise
+    # it's negotiated from the Accept header. Returns None for the original.
+    raw_width = request.args.get("w")
+    if raw_width is None:
+        return None
+    widths = current_app.config["MEDIA_VARIANT_WIDTHS"]
+    if not raw_width.isdigit() or int(raw_width) not in widths:
+        abort(400, description=f"w must be one of {', '.join(map(str, widths))}")
+
+    fmt = request.args.get("fm")
+    if fmt is not None and (
+        fmt not in current_app.config["MEDIA_VARIANT_FORMATS"] or not media_variants.can_encode(fmt)
+    ):
+        abort(400, description=f"Unsupported format {fmt!r}")
+    return int(raw_width), fmt
+
+
+def _negotiate_format(source_fmt: str) -> str:
+    # Only formats the client names explicitly count, "*/*" doesn't mean it
+    # can decode AVIF.
+    accepted = {value for value, quality in request.accept_mimetypes if quality > 0}
+    for fmt in current_app.config["MEDIA_VARIANT_FORMATS"]:
+        if media_variants.FORMATS[fmt][0] in accepted and media_variants.can_encode(fmt):
+            return fmt
+    return source_fmt
+
+
+def _source_version(source: CachedMedia) -> str:
+    # What a variant was rendered from. Objects the bucket gives neither an
+    # ETag nor a Last-Modified fall back to the hash of their bytes.
+    meta = source.meta
+    return meta["etag"] or meta["last_modified"] or meta.get("sha256") or str(meta["stored_at"])
+
+
+def _render_variant(cache: MediaCache, source: CachedMedia, variant_key: str, width: int, fmt: str):
+    cfg = current_app.config
+    version = _source_version(source)
+
+    with cache.fill_lock(variant_key, cfg["MEDIA_FILL_LOCK_TIMEOUT"]):
+        # Another worker may have rendered it while we waited for the lock
+        variant = cache.get(variant_key)
+        if variant is not None and variant.meta.get("source") == version:
+            _count("variant_coalesced_between_workers")
+            return variant, "HIT"
+
+        _count("variant_renders")
+        try:
+            data = media_variants.render(
+                source.path, width, fmt, cfg["MEDIA_VARIANT_QUALITY"], cfg["MEDIA_VARIANT_MAX_PIXELS"]
+            )
+        except FileNotFoundError:
+            raise
+        except Exception:
+            # Corrupt or oversized images still get served, just not resized
+            current_app.logger.warning("Could not resize %s", variant_key, exc_info=True)
+            return source, "BYPASS"
+
+        etag = source.meta["etag"].strip('"') if source.meta["etag"] else str(int(source.meta["stored_at"]))
+        variant = cache.put(variant_key, [data], {
+            "etag": f'"{etag}-{width}{fmt}"',
+            "last_modified": source.meta["last_modified"],
+            "content_type": media_variants.FORMATS[fmt][0],
+            "source": version,
+        })
+        return variant, "MISS"
+
+
+def _serve_variant(cache: MediaCache, bucket: str, s3_key: str, key: str, width: int, fmt: str | None) -> Response:
+    source = cache.get(s3_key)
+    if source is not None and not cache.is_stale(source):
+        _count("cache_hits")
+    else:
+        result, shared = _fill_shared(cache, bucket, s3_key, key)
+        if not isinstance(result, tuple):
+            return _stream_uncached(result, shared, bucket, s3_key, key)
+        source = result[0]
+
+    source_fmt = media_variants.SOURCE_FORMATS.get(source.meta["content_type"])
+    if source_fmt is None:
+        # GIFs, SVGs and the like are always served as they are
+        return _send_cached(source, "HIT")
+
+    negotiated = fmt is None
+    if negotiated:
+        fmt = _negotiate_format(source_fmt)
+
+    variant_key = f"{s3_key}?w={width}&fm={fmt}"
+    version = _source_version(source)
+    try:
+        variant = cache.get(variant_key)
+        if variant is not None and variant.meta.get("source") == version:
+            _count("variant_hits")
+            response = _send_cached(variant, "HIT")
+        else:
+            flights = current_app.extensions["media_flights"]
+            (variant, cache_status), shared = flights.do(
+                variant_key, lambda: _render_variant(cache, source, variant_key, width, fmt)
+            )
+            response = _send_cached(variant, "COALESCED" if shared else cache_status)
+    except FileNotFoundError:
+        # The source or variant was evicted underneath us
+        return _serve_from_cache(cache, bucket, s3_key, key)
+
+    if negotiated:
+        response.vary.add("Accept")
+    return response
+
+
+def _stream_response(obj: dict, meta: dict) -> Response:
+    headers = _base_headers(meta)
+    headers["Content-Length"] = str(obj["ContentLength"])
+    status = 200
+    if obj.get("ContentRange"):
+        status = 206
+        headers["Content-Range"] = obj["ContentRange"]
+
+    # Stream response so you don't load whole file into memory
+    return Response(stream_with_context(obj["Body"].iter_chunks(chunk_size=8192)), status=status, headers=headers)
+
+
+@bp.route("/media/<path:key>", methods=["GET", "HEAD"])
+def media_proxy(key: str):
+    # key is like: blog_body_images/foo.png
+    current_app.logger.info("MEDIA_PROXY requested key=%s", key)
+
+    bucket = current_app.config["AWS_STORAGE_BUCKET_NAME"]
+    s3_key = f"media/{key}".lstrip("/")  # matches your django-storages "location": "media"
+
+    current_app.logger.info("S3 key=%s", s3_key)
+
+    if _is_known_missing(s3_key):
+        _count("negative_hits")
+        abort(404)
+
+    cache = current_app.extensions.get("media_cache")
+    if current_app.config["MEDIA_VARIANTS_ENABLED"]:
+        # Checked even when nothing can be resized here, so a srcset URL is
+        # rejected or served the same whichever way the cache is set up
+        variant = _requested_variant()
+        # Resized copies only exist in the cache, whatever the delivery mode
+        if variant is not None and cache is not None and media_variants.enabled(current_app.config):
+            return _serve_variant(cache, bucket, s3_key, key, *variant)
+
+    delivery = current_app.config["MEDIA_DELIVERY"]
+    if delivery == "redirect":
+        return _redirect_presigned(bucket, s3_key)
+    if cache is not None:
+        return _serve_from_cache(cache, bucket, s3_key, key)
+    if delivery == "accel":
+        return _accel_s3(bucket, s3_key)
+
+    meta = None
+    conditional = (
+        "If-None-Match" in request.headers
+        or "If-Modified-Since" in request.headers
+        or "If-Range" in request.headers
+    )
+    if conditional or request.method == "HEAD":
+        meta = _head(bucket, s3_key, key)
+        if not is_resource_modified(request.environ, etag=meta["etag"], last_modified=meta["last_modified"]):
+            return Response(status=304, headers=_base_headers(meta))
+        if request.method == "HEAD":
+            response = Response(headers=_base_headers(meta))
+            response.headers["Content-Length"] = str(meta["size"])
+            return response
+
+    params = {"Bucket": bucket, "Key": s3_key}
+    # Only single ranges are passed on; anything fancier gets the whole object
+    byte_range = request.range
+    if byte_range is not None and byte_range.units == "bytes" and len(byte_range.ranges) == 1:
+        if meta is None or _if_range_matches(meta):
+            params["Range"] = byte_range.to_header()
+
+    from botocore.exceptions import ClientError
+
+    _count("upstream_requests")
+    try:
+        with metrics.span("s3"):
+            obj = _s3_client().get_object(**params)
+    except ClientError as e:
+        code = _error_code(e)
+        if code in ("NoSuchKey", "404"):
+            _remember_missing(s3_key)
+            abort(404)
+        if code == "InvalidRange":
+            meta = meta or _head(bucket, s3_key, key)
+            return Response(status=416, headers={"Content-Range": f"bytes */{meta['size']}"})
+        abort(502)
+
+    meta = _metadata(obj, key)
+    current_app.extensions["media_metadata"].set(s3_key, (meta, time.time()))
+    return _stream_response(obj, meta)
@@ -8,9 +8,10 @@ import pytz
 from wtforms import BooleanField, StringField, EmailField, TextAreaField
 from wtforms.validators import DataRequired, InputRequired, Length
 
-from hackspace_website import mailer, mosparo
+from hackspace_website import mailer, mosparo, ratelimit, submissions
 
 bp = Blueprint('report', __name__)
+bp.before_request(ratelimit.check_request)
 
 class ReportForm(FlaskForm):
         name = StringField(
@@ -58,6 +59,9 @@ def report():
     if request.method == "POST":
         if mosparo.verify_formdata():
             if form.validate_on_submit():
+                    limited = ratelimit.limit_submission()
+                    if limited is not None:
+                         return limited
                     name = form.name.data.strip()
                     if not name:
                          name = "Anonymous"
@@ -72,6 +76,12 @@ def report():
                     tz = pytz.timezone(current_app.config["TIMEZONE"])
                     now = tz.localize(datetime.now().replace(microsecond=0))
 
+                    submissions.record_message(
+                         name=name,
+                         email=form.email.data.strip(),
+                         subject="Safety report",
+                         message=text,
+                    )
                     mailer.send_internal(
                          reply_to=form.email.data.strip(),
                          subject=f"New message via report form (submitted {now.isoformat()})",
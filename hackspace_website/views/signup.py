@@ -1,5 +1,5 @@
 from flask import (
-    Blueprint, render_template, redirect, current_app, url_for
+    Blueprint, render_template, redirect, current_app, request, url_for
 )
 from flask_wtf import FlaskForm
 from markupsafe import Markup
@@ -7,6 +7,8 @@ from wtforms import BooleanField, SubmitField
 from werkzeug.exceptions import BadRequest
 from wtforms.validators import DataRequired
 
+from hackspace_website.page_cache import render_page
+
 bp = Blueprint('signup', __name__, url_prefix="/dd-signup")
 
 class SignupForm(FlaskForm):
@@ -45,6 +47,8 @@ def index():
 
     if form.validate_on_submit():
         return redirect(url_for('.tiers'))
+    if request.method == "GET":
+        return render_page("pages/signup.html", form=form)
     return render_template("pages/signup.html", form=form)
 
 
@@ -62,4 +66,6 @@ def tiers():
         else:
             raise BadRequest("Must submit payment tier button")
         return redirect(url)
+    if request.method == "GET":
+        return render_page("pages/membership_tiers.html", form=form)
     return render_template("pages/membership_tiers.html", form=form)
\ No newline at end of file
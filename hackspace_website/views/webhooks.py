@@ -0,0 +1,100 @@
+import hashlib
+import hmac
+import time
+
+from flask import Blueprint, abort, current_app, jsonify, request
+
+from hackspace_website import cms, prefetch
+
+bp = Blueprint('webhooks', __name__, url_prefix="/hooks")
+
+
+def _signature_ok(secret: str) -> bool:
+    # X-CMS-Signature: sha256=<hex HMAC of "<X-CMS-Timestamp>.<body>">
+    timestamp = request.headers.get("X-CMS-Timestamp", "")
+    signature = request.headers.get("X-CMS-Signature", "")
+    if not timestamp.isdigit() or not signature.startswith("sha256="):
+        return False
+    # Don't accept a captured request being replayed later
+    if abs(time.time() - int(timestamp)) > current_app.config["CMS_WEBHOOK_MAX_SKEW"]:
+        return False
+    expected = hmac.new(
+        secret.encode(), timestamp.encode() + b"." + request.get_data(), hashlib.sha256
+    ).hexdigest()
+    return hmac.compare_digest(expected, signature[len("sha256="):])
+
+
+def _list_page_urls() -> list:
+    # Pages of the list fetched on demand from a paginated CMS endpoint
+    cfg = current_app.config
+    if not cfg["CMS_BLOG_LIST_PAGINATED"]:
+        return []
+    per_page = cfg["BLOG_PAGE_SIZE"]
+    first = current_app.extensions["cms_cache"].peek(prefetch.list_page_url(1, per_page))
+    count = first["count"] if isinstance(first, dict) else 0
+    return [prefetch.list_page_url(page, per_page) for page in range(1, count // per_page + 2)]
+
+
+def _affected_urls(payload: dict) -> list:
+    cfg = current_app.config
+    model = payload.get("model")
+    slug = payload.get("slug")
+    if model == "blog" and slug:
+        return [cfg["CMS_BLOG_DETAIL_URL"].format(slug=slug), cfg["CMS_BLOG_LIST_URL"]]
+    if model == "blog":
+        return [cfg["CMS_BLOG_LIST_URL"]]
+    if model == "open_day":
+        return [cfg["CMS_OPEN_DAY_URL"]]
+    return None  # don't know, drop everything
+
+
+def _refresh(urls: list) -> list:
+    # Fetch the new versions straight away, so the next visitor doesn't wait
+    # and, with prefetching, doesn't fall back to fetching on demand
+    cfg = current_app.config
+    cache = current_app.extensions["cms_cache"]
+    refreshed = []
+    for url in urls:
+        try:
+            if url == cfg["CMS_BLOG_LIST_URL"]:
+                value = prefetch.fetch_blog_list(cache)
+            else:
+                value = cache.fetch(url)
+        except Exception:
+            # e.g. a 404 for an unpublished post, which is fine as it's gone
+            current_app.logger.info("Not refreshing %s after CMS webhook", url, exc_info=True)
+            continue
+        if url == cfg["CMS_BLOG_LIST_URL"] or url == cfg["CMS_OPEN_DAY_URL"]:
+            cache.store(url, value)
+        elif "cms_prefetcher" in current_app.extensions:
+            prefetch.store_post(cache, url, value)
+        else:
+            # Nothing reads the rendered copy without the prefetcher
+            cache.store(url, value)
+        refreshed.append(url)
+    return refreshed
+
+
+@bp.route("/cms", methods=["POST"])
+def cms_webhook():
+    secret = current_app.config.get("CMS_WEBHOOK_SECRET")
+    if not secret:
+        abort(404)
+    if not _signature_ok(secret):
+        abort(403)
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        abort(400, description="Expected a JSON object")
+
+    urls = _affected_urls(payload)
+    if urls is None:
+        cms.invalidate(["*"])
+        return jsonify(invalidated="*", refreshed=[])
+
+    # Pages of a paginated list are fetched again on demand, not refreshed
+    pages = _list_page_urls() if current_app.config["CMS_BLOG_LIST_URL"] in urls else []
+    cms.invalidate([key for url in urls + pages for key in prefetch.cache_keys(url)])
+    refreshed = _refresh(urls)
+    current_app.logger.info("CMS webhook %s: invalidated %s", payload.get("event"), urls)
+    return jsonify(invalidated=urls, refreshed=refreshed)
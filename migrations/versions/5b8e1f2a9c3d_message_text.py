@@ -0,0 +1,33 @@
+"""Store the whole message body
+
+Revision ID: 5b8e1f2a9c3d
+Revises: c12241c6e237
+Create Date: 2026-10-18 18:02:11.421907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8e1f2a9c3d'
+down_revision = 'c12241c6e237'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The contact form allows 8000 characters and safety reports more
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('message',
+               existing_type=sa.String(length=2000),
+               type_=sa.Text(),
+               existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('message',
+               existing_type=sa.Text(),
+               type_=sa.String(length=2000),
+               existing_nullable=False)